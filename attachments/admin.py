@@ -1,9 +1,102 @@
-from django.contrib import admin
+import hashlib
+
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+
 from attachments.models import Attachment
+from attachments.utils import run_in_background
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator that avoids an exact ``COUNT(*)`` on big tables.
+
+    For an unfiltered changelist on PostgreSQL the planner's row estimate is
+    used once it exceeds ATTACHMENT_ADMIN_ESTIMATE_THRESHOLD. Every other
+    count is cached for ATTACHMENT_ADMIN_COUNT_TIMEOUT seconds.
+    """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None:
+            return super(EstimatedCountPaginator, self).count
+
+        if not query.where:
+            estimate = self._estimate(self.object_list)
+            threshold = getattr(
+                settings, 'ATTACHMENT_ADMIN_ESTIMATE_THRESHOLD', 100000)
+            if estimate is not None and estimate > threshold:
+                return estimate
+
+        key = 'attachments:admin-count:%s' % hashlib.md5(
+            str(query).encode('utf-8')).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = super(EstimatedCountPaginator, self).count
+            cache.set(
+                key,
+                count,
+                getattr(settings, 'ATTACHMENT_ADMIN_COUNT_TIMEOUT', 300),
+            )
+        return count
+
+    def _estimate(self, queryset):
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples FROM pg_class WHERE relname = %s',
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+        if not row or row[0] < 0:
+            return None
+        return int(row[0])
 
 
 class AttachmentAdmin(admin.ModelAdmin):
     list_display = ("file", "title", "summary", "attached_timestamp", "attached_by")  # noqa E501
+    list_select_related = ("attached_by",)
+    list_filter = ("content_type",)
+    date_hierarchy = "attached_timestamp"
+    raw_id_fields = ("content_type",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ("delete_in_background", "recompute_metadata")
+
+    def delete_in_background(self, request, queryset):
+        # Hand over the query rather than the primary keys, which could be
+        # millions; the task pages through it itself.
+        run_in_background(
+            Attachment.objects.delete_in_batches, queryset.query)
+        self.message_user(
+            request,
+            _("Deleting the selected attachments in the background."),
+            messages.SUCCESS,
+        )
+
+    delete_in_background.short_description = _(
+        "Delete selected attachments in the background")
+    delete_in_background.allowed_permissions = ('delete',)
+
+    def recompute_metadata(self, request, queryset):
+        run_in_background(
+            Attachment.objects.recompute_metadata, queryset.query)
+        self.message_user(
+            request,
+            _("Recomputing the selected attachments in the background."),
+            messages.SUCCESS,
+        )
 
+    recompute_metadata.short_description = _(
+        "Recompute title and slug of selected attachments")
+    recompute_metadata.allowed_permissions = ('change',)
 
 admin.site.register(Attachment, AttachmentAdmin)
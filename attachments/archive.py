@@ -0,0 +1,93 @@
+"""
+Archives of attachment files: streaming ZIPs and digests.
+"""
+import hashlib
+import os.path
+import time
+import zipfile
+
+
+class _Buffer(object):
+    """
+    A write-only, unseekable file object handing out what was written
+    since the last ``take``.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def unique_name(name, used):
+    """
+    Returns ``name``, or ``name`` with a counter before its extension if it
+    is already in ``used``, and adds the result to ``used``.
+    """
+    root, ext = os.path.splitext(name)
+    candidate = name
+    n = 1
+    while candidate in used:
+        n += 1
+        candidate = '%s-%d%s' % (root, n, ext)
+    used.add(candidate)
+    return candidate
+
+
+def stream_zip(files, compression=zipfile.ZIP_STORED):
+    """
+    Yields a ZIP archive of ``files``, an iterable of ``(name, file)``
+    pairs where ``file`` has a ``chunks()`` method, such as a ``FieldFile``.
+
+    Entries are written with data descriptors, so nothing is seeked or
+    buffered beyond one chunk of one file at a time. Each file is closed
+    once it has been written.
+    """
+    buffer = _Buffer()
+    used = set()
+    date_time = time.localtime()[:6]
+    with zipfile.ZipFile(buffer, 'w', compression=compression) as archive:
+        for name, f in files:
+            info = zipfile.ZipInfo(unique_name(name, used), date_time)
+            info.compress_type = compression
+            try:
+                with archive.open(info, 'w', force_zip64=True) as entry:
+                    for chunk in f.chunks():
+                        entry.write(chunk)
+                        data = buffer.take()
+                        if data:
+                            yield data
+            finally:
+                f.close()
+            data = buffer.take()
+            if data:
+                yield data
+    yield buffer.take()
+
+
+def file_digest(f, chunk_size=None):
+    """
+    Returns the SHA-256 hex digest of ``f``, a ``File``, read in chunks.
+    Files opened in text mode are hashed as UTF-8.
+    """
+    digest = hashlib.sha256()
+    for chunk in f.chunks(chunk_size):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        digest.update(chunk)
+    return digest.hexdigest()
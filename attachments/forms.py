@@ -3,10 +3,27 @@ from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import gettext_lazy as _
 
 from attachments.models import Attachment
+from attachments.quotas import check_quota
 
 
 class AttachmentForm(forms.ModelForm):
 
+    def __init__(self, *args, **kwargs):
+        """
+        ``content_object`` and ``user``, if given, are checked against the
+        attachment quotas when the form is validated.
+        """
+        self.content_object = kwargs.pop('content_object', None)
+        self.user = kwargs.pop('user', None)
+        super(AttachmentForm, self).__init__(*args, **kwargs)
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if file and (self.content_object is not None or
+                     self.user is not None):
+            check_quota(self.user, self.content_object, file.size)
+        return file
+
     def save(self, content_object, *args, **kwargs):
         self.instance.content_type = ContentType.objects.get_for_model(
             content_object)
@@ -22,6 +39,14 @@ class AttachmentForm(forms.ModelForm):
 class AttachmentEditForm(forms.ModelForm):
     file = forms.FileField(required=False, label=_("file"))
 
+    def __init__(self, *args, **kwargs):
+        """
+        ``user``, if given, is who the attachment will be attached by after
+        the edit; a new file is checked against the quotas for them.
+        """
+        self.user = kwargs.pop('user', None)
+        super(AttachmentEditForm, self).__init__(*args, **kwargs)
+
     def clean_file(self):
         """
         Don't delete the old file if our edit doesn't upload a new one.
@@ -29,6 +54,14 @@ class AttachmentEditForm(forms.ModelForm):
         file = self.cleaned_data['file']
         if not file:
             file = self.instance.file
+        elif self.user is not None:
+            instance = self.instance
+            growth = file.size - instance.file_size
+            if self.user.pk == instance.attached_by_id:
+                check_quota(self.user, None, growth, count=0)
+            else:
+                check_quota(self.user, None, file.size)
+            check_quota(None, instance.content_object, growth, count=0)
 
         return file
 
@@ -0,0 +1,185 @@
+"""
+Timing and query instrumentation for attachment operations.
+
+Instrumented operations report an ``Event`` to every configured sink. Sinks
+are callables taking the event; they come from the
+ATTACHMENT_INSTRUMENTATION_SINKS setting (a list of callables in the same
+string format as TEMPLATE_LOADERS) and from ``add_sink``. When there are
+no sinks an instrumented call costs one extra function call.
+"""
+from contextlib import contextmanager
+import functools
+import logging
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+
+from .utils import get_callable_from_string
+
+
+logger = logging.getLogger(__name__)
+
+_sinks = None
+_extra_sinks = []
+
+
+class Event(object):
+    """
+    One instrumented operation: its ``name``, ``duration`` in seconds, the
+    number of ``queries`` it ran and the ``bytes`` it transferred, if any.
+    """
+    __slots__ = ('name', 'duration', 'queries', 'bytes')
+
+    def __init__(self, name, duration, queries=0, bytes=None):
+        self.name = name
+        self.duration = duration
+        self.queries = queries
+        self.bytes = bytes
+
+    def __repr__(self):
+        return '<Event %s %.6fs queries=%d bytes=%s>' % (
+            self.name, self.duration, self.queries, self.bytes)
+
+
+class LoggingSink(object):
+    """
+    Logs every event to the ``attachments.instrumentation`` logger.
+    """
+
+    def __init__(self, level=logging.DEBUG):
+        self.level = level
+
+    def __call__(self, event):
+        logger.log(
+            self.level,
+            '%s took %.2f ms, %d queries, %s bytes',
+            event.name,
+            event.duration * 1000,
+            event.queries,
+            event.bytes,
+        )
+
+
+class StatsdSink(object):
+    """
+    Reports events to a statsd-style ``client`` providing ``timing(name,
+    milliseconds)`` and ``incr(name, count)``.
+    """
+
+    def __init__(self, client, prefix='attachments'):
+        self.client = client
+        self.prefix = prefix
+
+    def __call__(self, event):
+        name = '%s.%s' % (self.prefix, event.name)
+        self.client.timing(name, event.duration * 1000)
+        self.client.incr('%s.queries' % name, event.queries)
+        if event.bytes is not None:
+            self.client.incr('%s.bytes' % name, event.bytes)
+
+
+class MemorySink(object):
+    """
+    Keeps every event in ``events``; meant for tests.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def names(self):
+        return [event.name for event in self.events]
+
+
+logging_sink = LoggingSink()
+
+
+def _load_sinks():
+    global _sinks
+    _sinks = [
+        get_callable_from_string(path)
+        for path in getattr(settings, 'ATTACHMENT_INSTRUMENTATION_SINKS', ())
+    ] + _extra_sinks
+    return _sinks
+
+
+def _reset_sinks(**kwargs):
+    global _sinks
+    _sinks = None
+
+
+setting_changed.connect(_reset_sinks)
+
+
+def add_sink(sink):
+    _extra_sinks.append(sink)
+    _reset_sinks()
+
+
+def remove_sink(sink):
+    _extra_sinks.remove(sink)
+    _reset_sinks()
+
+
+@contextmanager
+def collect():
+    """
+    Collects the events emitted inside the block into a ``MemorySink``.
+    """
+    sink = MemorySink()
+    add_sink(sink)
+    try:
+        yield sink
+    finally:
+        remove_sink(sink)
+
+
+def is_active():
+    """
+    Whether any sink is configured.
+    """
+    sinks = _sinks if _sinks is not None else _load_sinks()
+    return bool(sinks)
+
+
+def emit(event):
+    sinks = _sinks if _sinks is not None else _load_sinks()
+    for sink in sinks:
+        sink(event)
+
+
+def instrument(name, transferred=None):
+    """
+    Decorator reporting the duration and query count of each call as the
+    event ``name``. ``transferred``, if given, is called with the same
+    arguments as the decorated function and returns the bytes moved.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            sinks = _sinks if _sinks is not None else _load_sinks()
+            if not sinks:
+                return func(*args, **kwargs)
+
+            queries = [0]
+
+            def count(execute, sql, params, many, context):
+                queries[0] += 1
+                return execute(sql, params, many, context)
+
+            start = time.perf_counter()
+            with connection.execute_wrapper(count):
+                result = func(*args, **kwargs)
+            duration = time.perf_counter() - start
+
+            nbytes = None
+            if transferred is not None:
+                nbytes = transferred(*args, **kwargs)
+            emit(Event(name, duration, queries[0], nbytes))
+            return result
+        return wrapper
+    return decorator
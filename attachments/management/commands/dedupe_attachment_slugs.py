@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+
+from attachments.models import Attachment
+
+
+class Command(BaseCommand):
+    help = (
+        "Gives new slugs to attachments sharing a slug with an older "
+        "attachment of the same object. Run it before adding the unique "
+        "(content_type, object_id, slug) constraint to an existing table."
+    )
+
+    def handle(self, *args, **options):
+        duplicates = Attachment.objects.values(
+            'content_type', 'object_id', 'slug',
+        ).annotate(
+            rows=Count('pk'),
+            first_pk=Min('pk'),
+        ).filter(rows__gt=1).order_by()
+
+        fixed = 0
+        for row in duplicates.iterator():
+            with transaction.atomic():
+                batch = list(Attachment.objects.filter(
+                    content_type=row['content_type'],
+                    object_id=row['object_id'],
+                    slug=row['slug'],
+                ).exclude(pk=row['first_pk']))
+                for attachment in batch:
+                    # Forces set_slugs to pick a free slug.
+                    attachment.slug = None
+                Attachment.objects.set_slugs(batch)
+                Attachment.objects.bulk_update(batch, ['slug'])
+            fixed += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Gave new slugs to %d attachments' % fixed))
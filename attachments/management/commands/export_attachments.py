@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from attachments.models import Attachment
+
+
+MANIFEST = 'attachments.ndjson'
+FILES_DIR = 'files'
+
+
+def blob_path(directory, digest):
+    """
+    Where the file with ``digest`` is kept in an export ``directory``.
+    """
+    return os.path.join(directory, FILES_DIR, digest[:2], digest)
+
+
+class Command(BaseCommand):
+    help = (
+        "Exports attachments to a directory: one JSON object per line in "
+        "%s and the files under %s/, named by their SHA-256 digest so "
+        "shared files are stored once." % (MANIFEST, FILES_DIR)
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument(
+            '--content-type', metavar='APP_LABEL.MODEL',
+            help='Only export attachments of this model.')
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        os.makedirs(os.path.join(directory, FILES_DIR), exist_ok=True)
+
+        queryset = Attachment.objects.select_related(
+            'content_type', 'attached_by').order_by('pk')
+        if options['content_type']:
+            try:
+                app_label, model = options['content_type'].split('.')
+            except ValueError:
+                raise CommandError('Use APP_LABEL.MODEL for --content-type')
+            queryset = queryset.filter(
+                content_type__app_label=app_label,
+                content_type__model=model.lower(),
+            )
+
+        count = 0
+        with open(os.path.join(directory, MANIFEST), 'w') as manifest:
+            for attachment in queryset.iterator(options['batch_size']):
+                row = self.serialize(attachment)
+                if attachment.file:
+                    row['size'], row['sha256'] = self.store_file(
+                        directory, attachment.file)
+                    if attachment.sha256 != row['sha256']:
+                        # Fills in the digest of attachments saved before
+                        # it was recorded, for import to compare against.
+                        Attachment.objects.filter(pk=attachment.pk).update(
+                            sha256=row['sha256'])
+                manifest.write(json.dumps(row, sort_keys=True))
+                manifest.write('\n')
+                count += 1
+        self.stdout.write(self.style.SUCCESS(
+            'Exported %d attachments to %s' % (count, directory)))
+
+    def serialize(self, attachment):
+        user = attachment.attached_by
+        if hasattr(user, 'natural_key'):
+            attached_by = list(user.natural_key())
+        else:
+            attached_by = user.pk
+        return {
+            'content_type': list(attachment.content_type.natural_key()),
+            'object_id': attachment.object_id,
+            'title': attachment.title,
+            'slug': attachment.slug,
+            'summary': attachment.summary,
+            'attached_timestamp': attachment.attached_timestamp.isoformat(),
+            'attached_by': attached_by,
+            'file': attachment.file.name,
+            'size': None,
+            'sha256': None,
+        }
+
+    def store_file(self, directory, field_file):
+        """
+        Streams ``field_file`` into the export while hashing it, and returns
+        its size and digest.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.join(directory, FILES_DIR))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                field_file.open('rb')
+                try:
+                    for chunk in field_file.chunks():
+                        digest.update(chunk)
+                        size += len(chunk)
+                        out.write(chunk)
+                finally:
+                    field_file.close()
+            path = blob_path(directory, digest.hexdigest())
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return size, digest.hexdigest()
@@ -0,0 +1,172 @@
+from datetime import datetime
+from itertools import islice
+import json
+import os
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from attachments.management.commands.export_attachments import (
+    MANIFEST,
+    blob_path,
+)
+from attachments.models import Attachment
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports attachments exported with export_attachments. Rows already "
+        "present (same object and file digest, or same slug for rows "
+        "without a file) are skipped, and files already stored under the "
+        "same name and digest are not copied again. Digests are compared "
+        "as recorded in the database, which exporting fills in for older "
+        "attachments."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        self.directory = options['directory']
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        if not os.path.exists(manifest_path):
+            raise CommandError('%s not found' % manifest_path)
+
+        self.storage = Attachment._meta.get_field('file').storage
+        self.content_types = {}
+        self.users = {}
+        created = skipped = copied = 0
+
+        with open(manifest_path) as manifest:
+            rows = (json.loads(line) for line in manifest if line.strip())
+            while True:
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                new = self.new_rows(batch)
+                skipped += len(batch) - len(new)
+
+                attachments = []
+                for row in new:
+                    attachment, was_copied = self.build(row)
+                    attachments.append(attachment)
+                    copied += was_copied
+                Attachment.objects.bulk_create(attachments, keep_slugs=True)
+                created += len(attachments)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Imported %d attachments (%d files copied), skipped %d' % (
+                created, copied, skipped)))
+
+    def content_type(self, natural_key):
+        natural_key = tuple(natural_key)
+        if natural_key not in self.content_types:
+            self.content_types[natural_key] = \
+                ContentType.objects.get_by_natural_key(*natural_key)
+        return self.content_types[natural_key]
+
+    def user(self, key):
+        key = tuple(key) if isinstance(key, list) else key
+        if key not in self.users:
+            User = get_user_model()
+            if isinstance(key, tuple):
+                user = User._default_manager.get_by_natural_key(*key)
+            else:
+                user = User._default_manager.get(pk=key)
+            self.users[key] = user
+        return self.users[key]
+
+    def key(self, content_type, object_id, digest, slug):
+        """
+        Identifies an attachment across imports: its object and the digest
+        of its file, or its slug if it has no file. Slugs are kept by the
+        import, but may have been renamed on either side before.
+        """
+        if digest:
+            return (content_type, object_id, 'sha256', digest)
+        return (content_type, object_id, 'slug', slug)
+
+    def new_rows(self, batch):
+        """
+        Drops the rows of ``batch`` that were imported before or repeat an
+        earlier row of the batch, comparing the recorded digests with one
+        query. Also notes which exported files are already in storage.
+        """
+        by_type = {}
+        for row in batch:
+            by_type.setdefault(tuple(row['content_type']), []).append(row)
+
+        natural_keys = {}
+        lookups = Q(
+            file__in=set(row['file'] for row in batch if row['sha256']),
+            sha256__in=set(row['sha256'] for row in batch if row['sha256']),
+        )
+        for natural_key, rows in by_type.items():
+            content_type = self.content_type(natural_key)
+            natural_keys[content_type.pk] = natural_key
+            object_ids = set(row['object_id'] for row in rows)
+            lookups |= Q(
+                content_type=content_type,
+                object_id__in=object_ids,
+                sha256__in=set(row['sha256'] for row in rows if row['sha256']),
+            )
+            lookups |= Q(
+                content_type=content_type,
+                object_id__in=object_ids,
+                file='',
+                slug__in=set(row['slug'] for row in rows if not row['sha256']),
+            )
+
+        existing = set()
+        self.stored = {}
+        for content_type_id, object_id, name, digest, slug in \
+                Attachment.objects.filter(lookups).values_list(
+                    'content_type', 'object_id', 'file', 'sha256', 'slug'):
+            if name:
+                self.stored[(name, digest)] = name
+            existing.add(self.key(
+                natural_keys.get(content_type_id), object_id,
+                digest if name else None, slug))
+
+        new = []
+        for row in batch:
+            key = self.key(
+                tuple(row['content_type']), row['object_id'],
+                row['sha256'], row['slug'])
+            if key not in existing:
+                existing.add(key)
+                new.append(row)
+        return new
+
+    def build(self, row):
+        """
+        Returns an unsaved attachment for ``row`` and whether its file had
+        to be copied into storage.
+        """
+        attachment = Attachment(
+            content_type=self.content_type(row['content_type']),
+            object_id=row['object_id'],
+            title=row['title'],
+            slug=row['slug'],
+            summary=row['summary'],
+            attached_timestamp=datetime.fromisoformat(
+                row['attached_timestamp']),
+            attached_by=self.user(row['attached_by']),
+            file_size=row['size'] or 0,
+            sha256=row['sha256'] or '',
+        )
+        name = row['file']
+        stored = (name, row['sha256'])
+        if not row['sha256'] or stored in self.stored:
+            attachment.file = self.stored.get(stored, name)
+            return attachment, False
+
+        path = blob_path(self.directory, row['sha256'])
+        with open(path, 'rb') as f:
+            attachment.file = self.storage.save(name, File(f))
+        self.stored[stored] = attachment.file.name
+        return attachment, True
@@ -0,0 +1,221 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import os
+
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+
+from attachments.archive import file_digest
+from attachments.models import Attachment
+from attachments.storage import get_tier_storage
+from attachments.utils import get_callable_from_string
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves attachment files to another storage tier and/or directory "
+        "scheme. Files are copied before the rows are updated, so readers "
+        "never see a missing file, and an interrupted run can be resumed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--to-tier', default='',
+            help='Target tier from ATTACHMENT_STORAGE_TIERS; empty for the '
+                 'default storage.')
+        parser.add_argument(
+            '--from-tier',
+            help='Only move attachments currently in this tier.')
+        parser.add_argument(
+            '--older-than', type=int, metavar='DAYS',
+            help='Only move attachments attached more than DAYS ago.')
+        parser.add_argument(
+            '--scheme', metavar='CALLABLE',
+            help='Directory scheme for the new file names, in the format of '
+                 'ATTACHMENT_STORAGE_DIR. Names are kept when omitted.')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument(
+            '--checkpoint', metavar='FILE',
+            help='Records the last migrated primary key and the failed '
+                 'attachments, to resume from and retry.')
+        parser.add_argument(
+            '--delete-source', action='store_true',
+            help='Delete the old files once their rows point at the copies.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        self.target_tier = options['to_tier']
+        self.target = get_tier_storage(
+            self.target_tier, Attachment._meta.get_field('file').storage)
+        self.scheme = None
+        if options['scheme']:
+            self.scheme = get_callable_from_string(options['scheme'])
+        if self.scheme is None and options['from_tier'] == self.target_tier:
+            raise CommandError('Nothing to do: same tier and no --scheme.')
+
+        queryset = Attachment.objects.order_by('pk')
+        if options['from_tier'] is not None:
+            queryset = queryset.filter(storage_tier=options['from_tier'])
+        if self.scheme is None:
+            queryset = queryset.exclude(storage_tier=self.target_tier)
+        if options['older_than'] is not None:
+            cutoff = datetime.now() - timedelta(days=options['older_than'])
+            queryset = queryset.filter(attached_timestamp__lt=cutoff)
+
+        checkpoint = options['checkpoint']
+        state = self.read_checkpoint(checkpoint)
+        # Attachments that failed in an earlier run are retried first.
+        self.retry = state['failed']
+        self.failed = []
+        last_pk = state['last_pk']
+        moved = 0
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            for batch in self.batches(queryset, last_pk,
+                                      options['batch_size']):
+                last_pk = max(last_pk, batch[-1].pk)
+                # Schemes may query the database, so names are resolved
+                # here rather than in the pool threads.
+                names = [self.new_name(attachment) for attachment in batch]
+
+                if options['dry_run']:
+                    for attachment, name in zip(batch, names):
+                        self.stdout.write('%s -> %s' % (
+                            attachment.file.name, name))
+                    continue
+
+                results = list(pool.map(self.copy_file, batch, names))
+                done = []
+                for attachment, new_name in zip(batch, results):
+                    if new_name is None:
+                        self.failed.append(attachment.pk)
+                        continue
+                    done.append((
+                        attachment,
+                        attachment.storage_tier,
+                        attachment.file.name,
+                    ))
+                    attachment.storage_tier = self.target_tier
+                    attachment.file = new_name
+                Attachment.objects.bulk_update(
+                    [attachment for attachment, old_tier, old_name in done],
+                    ['file', 'storage_tier'],
+                )
+                if options['delete_source']:
+                    list(pool.map(self.delete_source, self.unused(done)))
+
+                moved += len(done)
+                self.write_checkpoint(checkpoint, {
+                    'last_pk': last_pk,
+                    'failed': self.retry + self.failed,
+                })
+                self.stdout.write('Moved %d attachments, %d failed' % (
+                    moved, len(self.failed)))
+
+        if checkpoint and not options['dry_run'] and not self.failed and \
+                os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write(self.style.SUCCESS(
+            'Done: moved %d attachments, %d failed' % (
+                moved, len(self.failed))))
+        if checkpoint and self.failed:
+            self.stdout.write(
+                'Run again with the same --checkpoint to retry the failed '
+                'attachments.')
+
+    def batches(self, queryset, last_pk, batch_size):
+        """
+        Yields the attachments to retry, then those after ``last_pk``,
+        ``batch_size`` at a time.
+        """
+        while self.retry:
+            pks, self.retry = self.retry[:batch_size], self.retry[batch_size:]
+            batch = list(queryset.filter(pk__in=pks))
+            if batch:
+                yield batch
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            yield batch
+
+    def new_name(self, attachment):
+        if self.scheme is None:
+            return attachment.file.name
+        return self.scheme(attachment, attachment.file_name())
+
+    def copy_file(self, attachment, name):
+        """
+        Streams the file of ``attachment`` to ``name`` in the target storage
+        and returns the name it was saved as, or None if the file couldn't
+        be copied. Runs in the pool threads, so it only touches storage.
+        """
+        old_file = attachment.file
+        try:
+            with old_file.storage.open(old_file.name, 'rb') as f:
+                if self.is_copy(name, File(f)):
+                    # Copied by an earlier, interrupted run.
+                    return name
+                return self.target.save(name, File(f))
+        except (IOError, OSError) as e:
+            self.stderr.write('Could not copy %s (attachment %s): %s' % (
+                old_file.name, attachment.pk, e))
+            return None
+
+    def is_copy(self, name, source):
+        """
+        Whether the target file ``name`` has the same content as ``source``.
+        Another attachment may map to the same name with a different file,
+        so only a matching digest counts.
+        """
+        if not self.target.exists(name) or \
+                self.target.size(name) != source.size:
+            return False
+        with self.target.open(name, 'rb') as f:
+            return file_digest(File(f)) == file_digest(source)
+
+    def unused(self, done):
+        """
+        Returns the ``(tier, name)`` of the old files of ``done`` which no
+        attachment points at anymore; shallow copies share their file.
+        """
+        old_files = {}
+        for attachment, old_tier, old_name in done:
+            if (old_tier, old_name) != (
+                    attachment.storage_tier, attachment.file.name):
+                old_files.setdefault(old_tier, set()).add(old_name)
+
+        unused = []
+        for tier, names in old_files.items():
+            in_use = set(Attachment.objects.filter(
+                storage_tier=tier,
+                file__in=names,
+            ).values_list('file', flat=True))
+            unused.extend((tier, name) for name in names - in_use)
+        return unused
+
+    def delete_source(self, old_file):
+        tier, name = old_file
+        storage = get_tier_storage(
+            tier, Attachment._meta.get_field('file').storage)
+        try:
+            storage.delete(name)
+        except (IOError, OSError) as e:
+            self.stderr.write('Could not delete %s: %s' % (name, e))
+
+    def read_checkpoint(self, path):
+        state = {'last_pk': 0, 'failed': []}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state.update(json.load(f))
+        return state
+
+    def write_checkpoint(self, path, state):
+        if not path:
+            return
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
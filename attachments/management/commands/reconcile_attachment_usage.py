@@ -0,0 +1,149 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Sum
+
+from attachments.models import (
+    Attachment,
+    ObjectAttachmentUsage,
+    UserAttachmentUsage,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the per-user and per-object attachment usage counters "
+        "from the attachments table, fixing any drift."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--measure-files', action='store_true',
+            help='First refill file_size from storage for attachments that '
+                 'have none recorded.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['measure_files']:
+            self.measure_files(batch_size)
+
+        fixed = self.reconcile(
+            UserAttachmentUsage,
+            (('attached_by', 'user_id'),),
+            batch_size,
+        )
+        fixed += self.reconcile(
+            ObjectAttachmentUsage,
+            (
+                ('content_type', 'content_type_id'),
+                ('object_id', 'object_id'),
+            ),
+            batch_size,
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            'Fixed %d usage counters' % fixed))
+
+    def measure_files(self, batch_size):
+        queryset = Attachment.objects.filter(file_size=0).exclude(file='')
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk).order_by('pk').only(
+                'pk', 'file', 'storage_tier')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            for attachment in batch:
+                try:
+                    attachment.file_size = attachment.file.size
+                except (IOError, OSError):
+                    self.stderr.write('Missing file %s (attachment %s)' % (
+                        attachment.file.name, attachment.pk))
+            Attachment.objects.bulk_update(batch, ['file_size'])
+
+    def reconcile(self, model, fields, batch_size):
+        """
+        Compares the counters of ``model`` with the aggregates of the
+        attachments grouped by ``fields``, pairs of attachment and counter
+        fields, and fixes the ones that differ one batch at a time.
+        """
+        attachment_fields = [field for field, _ in fields]
+        counter_fields = [field for _, field in fields]
+        totals = Attachment.objects.values(*attachment_fields).annotate(
+            total_count=Count('pk'),
+            total_size=Sum('file_size'),
+        ).order_by().iterator(batch_size)
+        # Counters left over from attachments that are all gone.
+        orphans = model.objects.filter(~Exists(
+            Attachment.objects.filter(**dict(
+                (field, OuterRef(counter_field))
+                for field, counter_field in fields
+            ))
+        )).exclude(count=0, size=0).values_list(*counter_fields).order_by()
+
+        fixed = 0
+        keys = set()
+        for row in totals:
+            keys.add(tuple(row[field] for field in attachment_fields))
+            if len(keys) == batch_size:
+                fixed += self.fix_batch(model, fields, keys)
+                keys = set()
+        for key in orphans.iterator(batch_size):
+            keys.add(key)
+            if len(keys) == batch_size:
+                fixed += self.fix_batch(model, fields, keys)
+                keys = set()
+        if keys:
+            fixed += self.fix_batch(model, fields, keys)
+        return fixed
+
+    def fix_batch(self, model, fields, keys):
+        """
+        Sets the counters of ``model`` for ``keys`` to the aggregates of
+        their attachments and returns how many changed. The counters are
+        locked before the aggregates are recomputed, in one transaction, so
+        uploads and deletes counted meanwhile are neither lost nor counted
+        twice.
+        """
+        def matching(queryset, names):
+            return queryset.filter(**dict(
+                ('%s__in' % name, set(key[i] for key in keys))
+                for i, name in enumerate(names)
+            ))
+
+        attachment_fields = [field for field, _ in fields]
+        counter_fields = [field for _, field in fields]
+        with transaction.atomic():
+            usages = {}
+            for usage in matching(model.objects.select_for_update(),
+                                  counter_fields):
+                key = tuple(getattr(usage, field) for field in counter_fields)
+                if key in keys:
+                    usages[key] = usage
+
+            totals = {}
+            for row in matching(
+                    Attachment.objects.values(*attachment_fields),
+                    attachment_fields).annotate(
+                    total_count=Count('pk'),
+                    total_size=Sum('file_size')).order_by():
+                key = tuple(row[field] for field in attachment_fields)
+                totals[key] = (row['total_count'], row['total_size'] or 0)
+
+            changed = []
+            missing = []
+            for key in keys:
+                count, size = totals.get(key, (0, 0))
+                usage = usages.get(key)
+                if usage is None:
+                    if count:
+                        missing.append(model(count=count, size=size, **dict(
+                            zip(counter_fields, key))))
+                elif (usage.count, usage.size) != (count, size):
+                    usage.count = count
+                    usage.size = size
+                    changed.append(usage)
+
+            model.objects.bulk_update(changed, ['count', 'size'])
+            model.objects.bulk_create(missing, ignore_conflicts=True)
+        return len(changed) + len(missing)
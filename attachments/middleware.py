@@ -2,6 +2,8 @@ from functools import cmp_to_key
 
 from django.utils.deprecation import MiddlewareMixin
 
+from attachments.throttling import check_upload, release_upload
+
 
 def cmp(a, b):
     # cmp() is removed in python 3
@@ -39,3 +41,22 @@ class AcceptMiddleware(MiddlewareMixin):
             t, p, q = toople
             return t
         request.accepted_types = list(map(mapper, accept))
+
+
+class UploadLimitMiddleware(MiddlewareMixin):
+    """
+    Refuses POSTs to the upload views over ATTACHMENT_MAX_UPLOAD_SIZE or
+    ATTACHMENT_MAX_CONCURRENT_UPLOADS before their body is read. Must come
+    before ``CsrfViewMiddleware`` in MIDDLEWARE; the views only fall back to
+    checking the limits themselves once the body has been read.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method == 'POST' and \
+                getattr(view_func, 'attachment_upload', False):
+            return check_upload(request)
+        return None
+
+    def process_response(self, request, response):
+        release_upload(request)
+        return response
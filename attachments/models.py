@@ -1,11 +1,10 @@
 from __future__ import with_statement
 
-import tempfile
-import shutil
-
-from six.moves.urllib.request import urlopen
-
-from django.db import models, connection
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import F
+from django.db.models.deletion import Collector
+from django.db.models.signals import post_delete
+from django.db.models.fields.files import FieldFile
 from django.core.files import File
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -14,13 +13,24 @@ from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ImproperlyConfigured
 
 import os.path
+import time
 from datetime import datetime
 
+from .archive import file_digest
 from .directory_schemes import by_app
-from .utils import get_callable_from_string, set_slug_field
+from .instrumentation import Event, emit, instrument, is_active
+from .storage import get_tier_storage
+from .utils import get_callable_from_string, set_slug_fields
+from .versions import bump_versions
 
 
-qn = connection.ops.quote_name
+def qn(name):
+    """
+    Quotes ``name`` for the default database. Resolved on each call so that
+    importing this module doesn't touch the connection handler.
+    """
+    return connection.ops.quote_name(name)
+
 
 # Get relative media path
 try:
@@ -29,11 +39,87 @@ except Exception:
     ATTACHMENT_DIR = "attachments"
 
 
+# The columns shown by attachments/attachments.html apart from the summary,
+# plus the storage tier needed to build file URLs.
+SUMMARY_VIEW_FIELDS = (
+    'id',
+    'file',
+    'storage_tier',
+    'title',
+    'slug',
+    'attached_timestamp',
+    'attached_by',
+)
+
+# How many times a save picks a new slug after losing a race for it.
+SLUG_ATTEMPTS = 3
+
+
+class AttachmentQuerySet(models.QuerySet):
+
+    # Event reported to the instrumentation sinks when the queryset is
+    # evaluated; see instrumented().
+    _event_name = None
+
+    def instrumented(self, name):
+        """
+        Reports fetching the results, rather than building the queryset,
+        as the event ``name``.
+        """
+        clone = self._chain()
+        clone._event_name = name
+        return clone
+
+    def _clone(self):
+        clone = super(AttachmentQuerySet, self)._clone()
+        clone._event_name = self._event_name
+        return clone
+
+    def _fetch_all(self):
+        if self._event_name is None or self._result_cache is not None:
+            return super(AttachmentQuerySet, self)._fetch_all()
+        instrument(self._event_name)(
+            super(AttachmentQuerySet, self)._fetch_all)()
+
+    def delete(self):
+        """
+        Like ``QuerySet.delete``, but updates the usage counters once per
+        user and object rather than once per deleted attachment.
+        """
+        if not self.query.can_filter():
+            raise TypeError("Cannot use 'limit' or 'offset' with delete().")
+        attachments = list(self.order_by())
+        for attachment in attachments:
+            # Tells attachment_deleted the counters are taken care of.
+            attachment._usage_batched = True
+        with transaction.atomic(using=self.db):
+            collector = Collector(using=self.db)
+            collector.collect(attachments)
+            deleted = collector.delete()
+            record_usage(attachments, count=-1)
+        bump_attachment_versions(attachments)
+        self._result_cache = None
+        return deleted
+
+    def summary_view(self):
+        """
+        Loads only ``SUMMARY_VIEW_FIELDS``, leaving out the potentially
+        large ``summary`` and the other columns list pages don't show.
+        """
+        return self.only(*SUMMARY_VIEW_FIELDS)
+
+
 class AttachmentManager(models.Manager):
     """
     Methods borrowed from django-threadedcomments
     """
 
+    def get_queryset(self):
+        return AttachmentQuerySet(self.model, using=self._db)
+
+    def summary_view(self):
+        return self.get_queryset().summary_view()
+
     def _generate_object_kwarg_dict(self, content_object, **kwargs):
         """
         Generates the most comment keyword arguments for a given
@@ -48,6 +134,7 @@ class AttachmentManager(models.Manager):
             kwargs['object_id'] = content_object.id
         return kwargs
 
+    @instrument('manager.create_for_object')
     def create_for_object(self, content_object, **kwargs):
         """
         A simple wrapper around ``create`` for a given ``content_object``.
@@ -70,7 +157,115 @@ class AttachmentManager(models.Manager):
         if title:
             query = query.filter(title=title)
 
-        return query
+        return query.instrumented('manager.attachments_for_object')
+
+    @instrument('manager.set_slugs')
+    def set_slugs(self, attachments, keep_current=False):
+        """
+        Gives each of ``attachments`` a slug that is unique among the
+        attachments of its content object, using one query per object.
+        With ``keep_current``, any slug already set is kept if it is free.
+        """
+        scopes = {}
+        for attachment in attachments:
+            if not attachment.title:
+                attachment.title = attachment.file_name()
+            key = (attachment.content_type_id, attachment.object_id)
+            scopes.setdefault(key, []).append(attachment)
+
+        for (content_type_id, object_id), batch in scopes.items():
+            set_slug_fields(
+                batch,
+                [attachment.title for attachment in batch],
+                queryset=self.filter(
+                    content_type_id=content_type_id,
+                    object_id=object_id,
+                ),
+                keep_current=keep_current,
+            )
+
+    @instrument('manager.bulk_create')
+    def bulk_create(self, objs, *args, **kwargs):
+        """
+        Like ``QuerySet.bulk_create``, but fills in the title and a unique
+        slug of every attachment first, as ``Attachment.save`` would. Pass
+        ``keep_slugs=True`` to keep the slugs already set where they are
+        free, e.g. when importing.
+        """
+        keep_slugs = kwargs.pop('keep_slugs', False)
+        objs = list(objs)
+        for attempt in range(SLUG_ATTEMPTS, 0, -1):
+            self.set_slugs(objs, keep_current=keep_slugs)
+            try:
+                with transaction.atomic(using=self.db):
+                    created = super(AttachmentManager, self).bulk_create(
+                        objs, *args, **kwargs)
+                    for attachment in created:
+                        attachment.__dict__.pop('_file_size_change', None)
+                    record_usage(created)
+                break
+            except IntegrityError:
+                # Another insert took one of the slugs; pick them again.
+                if attempt == 1:
+                    raise
+        bump_attachment_versions(created)
+        return created
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        """
+        Like ``QuerySet.bulk_update``, but also invalidates the cached
+        fragments of the affected objects.
+        """
+        objs = list(objs)
+        updated = super(AttachmentManager, self).bulk_update(
+            objs, fields, *args, **kwargs)
+        bump_attachment_versions(objs)
+        return updated
+
+    def _pk_batches(self, query, batch_size):
+        """
+        Yields the primary keys of the attachments matched by ``query`` (a
+        ``QuerySet`` or, as background tasks receive it, its pickleable
+        ``query``), ``batch_size`` at a time in ascending order. Each batch
+        is fetched by seeking past the previous one, so only one batch is
+        in memory and rows changed in between don't shift the pages.
+        """
+        if isinstance(query, models.QuerySet):
+            queryset = query
+        else:
+            queryset = self.all()
+            queryset.query = query
+        queryset = queryset.order_by('pk').values_list('pk', flat=True)
+        last_pk = None
+        while True:
+            page = queryset
+            if last_pk is not None:
+                page = page.filter(pk__gt=last_pk)
+            pks = list(page[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            yield pks
+
+    @instrument('manager.delete_in_batches')
+    def delete_in_batches(self, query, batch_size=1000):
+        """
+        Deletes the attachments matched by ``query``, ``batch_size`` rows at
+        a time so no single statement locks a huge range.
+        """
+        for pks in self._pk_batches(query, batch_size):
+            self.filter(pk__in=pks).delete()
+
+    @instrument('manager.recompute_metadata')
+    def recompute_metadata(self, query, batch_size=1000):
+        """
+        Refills the derived title and slug of the attachments matched by
+        ``query``, ``batch_size`` rows at a time.
+        """
+        for pks in self._pk_batches(query, batch_size):
+            batch = list(self.filter(pk__in=pks))
+            self.set_slugs(batch)
+            self.bulk_update(batch, ['title', 'slug'])
 
     def _get_usage(
         self,
@@ -149,6 +344,7 @@ class AttachmentManager(models.Manager):
             attachments.append(a)
         return attachments
 
+    @instrument('manager.usage_for_queryset')
     def usage_for_queryset(self, queryset, counts=False, min_count=None):
         """
         Obtain a list of tags associated with instances of a model
@@ -163,8 +359,14 @@ class AttachmentManager(models.Manager):
         Passing a value for ``min_count`` implies ``counts=True``.
         """
 
-        extra_joins = ' '.join(queryset.query.get_from_clause()[0][1:])
-        where, params = queryset.query.where.as_sql()
+        compiler = queryset.query.get_compiler(using=queryset.db)
+        compiler.setup_query()
+        from_clause, params = compiler.get_from_clause()
+        extra_joins = ' '.join(from_clause[1:])
+        where = ''
+        if queryset.query.where:
+            where, where_params = compiler.compile(queryset.query.where)
+            params = list(params) + list(where_params)
         if where:
             extra_criteria = 'AND %s' % where
         else:
@@ -178,6 +380,7 @@ class AttachmentManager(models.Manager):
             params,
         )
 
+    @instrument('manager.copy_attachments')
     def copy_attachments(
         self,
         from_object,
@@ -195,14 +398,17 @@ class AttachmentManager(models.Manager):
 
         attachments = self.attachments_for_object(from_object)
 
-        return [
+        copies = [
             attachment.copy(
                 to_object,
                 deepcopy,
-                save_attachments,
+                save_attachment=False,
             )
             for attachment in attachments
         ]
+        if save_attachments:
+            self.bulk_create(copies)
+        return copies
 
 
 def get_attachment_dir(instance, filename):
@@ -226,10 +432,68 @@ def get_attachment_dir(instance, filename):
     return dir_builder(instance, filename)
 
 
+class AttachmentFieldFile(FieldFile):
+    """
+    A ``FieldFile`` using the storage of its attachment's tier and
+    reporting its storage reads and writes to the instrumentation sinks.
+    """
+
+    def __init__(self, instance, field, name):
+        super(AttachmentFieldFile, self).__init__(instance, field, name)
+        self.storage = get_tier_storage(
+            getattr(instance, 'storage_tier', None), field.storage)
+
+    @instrument(
+        'storage.write',
+        transferred=lambda self, name, content, save=True: content.size,
+    )
+    def save(self, name, content, save=True):
+        # Keep the recorded size and digest in step; Attachment.save() passes
+        # the size change on to the usage counters.
+        instance = self.instance
+        size = content.size
+        instance._file_size_change = (
+            getattr(instance, '_file_size_change', 0) +
+            size - instance.file_size
+        )
+        instance.file_size = size
+        instance.sha256 = file_digest(content)
+        super(AttachmentFieldFile, self).save(name, content, save)
+
+    @instrument('storage.open')
+    def open(self, mode='rb'):
+        return super(AttachmentFieldFile, self).open(mode)
+
+    def chunks(self, chunk_size=None):
+        chunks = super(AttachmentFieldFile, self).chunks(chunk_size)
+        if not is_active():
+            return chunks
+        return self._instrumented_chunks(chunks)
+
+    def _instrumented_chunks(self, chunks):
+        # Only the time spent reading counts, not the time the consumer
+        # spends between chunks.
+        duration = 0
+        transferred = 0
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            duration += time.perf_counter() - start
+            if chunk is None:
+                break
+            transferred += len(chunk)
+            yield chunk
+        emit(Event('storage.read', duration, 0, transferred))
+
+
+class AttachmentFileField(models.FileField):
+    attr_class = AttachmentFieldFile
+
+
 class Attachment(models.Model):
 
-    file = models.FileField(_("file"), upload_to=get_attachment_dir,
-                            max_length=255)
+    file = AttachmentFileField(_("file"), upload_to=get_attachment_dir,
+                               max_length=255)
     content_type = models.ForeignKey(
         ContentType,
         on_delete=models.CASCADE,
@@ -237,10 +501,18 @@ class Attachment(models.Model):
     object_id = models.PositiveIntegerField(db_index=True)
     content_object = GenericForeignKey("content_type", "object_id")
     attached_timestamp = models.DateTimeField(_("date attached"),
-                                              default=datetime.now)
+                                              default=datetime.now,
+                                              db_index=True)
     title = models.CharField(_("title"), max_length=200, blank=True, null=True)
     slug = models.SlugField(_("slug"), editable=False)
     summary = models.TextField(_("summary"), blank=True, null=True)
+    file_size = models.BigIntegerField(_("file size"), default=0,
+                                       editable=False)
+    storage_tier = models.CharField(_("storage tier"), max_length=32,
+                                    blank=True, default='', editable=False,
+                                    db_index=True)
+    sha256 = models.CharField(_("SHA-256"), max_length=64, blank=True,
+                              default='', editable=False, db_index=True)
     attached_by = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         verbose_name=_("attached by"),
@@ -256,15 +528,91 @@ class Attachment(models.Model):
         get_latest_by = 'attached_timestamp'
         verbose_name = _('attachment')
         verbose_name_plural = _('attachments')
+        constraints = [
+            models.UniqueConstraint(
+                fields=['content_type', 'object_id', 'slug'],
+                name='attachments_unique_object_slug',
+            ),
+        ]
 
     def __str__(self):
         return self.title or self.file_name()
 
-    def save(self, force_insert=False, force_update=False, **kwargs):
-        set_slug_field(self, self.title)
-        if not self.title:
-            self.title = self.file_name()
-        super(Attachment, self).save(force_insert, force_update)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        attachment = super(Attachment, cls).from_db(db, field_names, values)
+        attachment._loaded_scope = attachment._usage_scope()
+        return attachment
+
+    def _usage_scope(self):
+        """
+        The user and object whose usage counters include this attachment,
+        or None if some of them weren't loaded.
+        """
+        scope = tuple(
+            self.__dict__.get(name)
+            for name in ('attached_by_id', 'content_type_id', 'object_id')
+        )
+        return None if None in scope else scope
+
+    def _stored_scope(self):
+        scope = self.__dict__.get('_loaded_scope')
+        if scope is None:
+            scope = Attachment.objects.filter(pk=self.pk).values_list(
+                'attached_by', 'content_type', 'object_id').first()
+        return scope
+
+    def _record_update(self, old_scope, size_change, enforce_quotas=False):
+        """
+        Updates the usage counters after saving changes, moving the
+        attachment between users or objects if it was reassigned.
+
+        With ``enforce_quotas``, a bigger file or the user or object taking
+        over the attachment must stay within the quotas.
+        """
+        if old_scope is None or old_scope == self._usage_scope():
+            if size_change:
+                record_usage([self], count=0, size=size_change,
+                             enforce_quotas=enforce_quotas)
+            return
+        attached_by_id, content_type_id, object_id = old_scope
+        old = Attachment(
+            attached_by_id=attached_by_id,
+            content_type_id=content_type_id,
+            object_id=object_id,
+            file_size=self.file_size - size_change,
+        )
+        record_usage([old], count=-1)
+        record_usage([self], enforce_quotas=enforce_quotas)
+        bump_attachment_versions([old])
+
+    def save(self, force_insert=False, force_update=False,
+             enforce_quotas=False, **kwargs):
+        """
+        With ``enforce_quotas``, raises ``QuotaExceeded`` and leaves the
+        database untouched if adding this attachment, growing its file or
+        reassigning it would exceed one of the quotas of its user or object.
+        """
+        adding = self._state.adding
+        old_scope = None if adding else self._stored_scope()
+        for attempt in range(SLUG_ATTEMPTS, 0, -1):
+            Attachment.objects.set_slugs([self])
+            try:
+                with transaction.atomic():
+                    super(Attachment, self).save(force_insert, force_update)
+                    size_change = self.__dict__.pop('_file_size_change', 0)
+                    if adding:
+                        record_usage([self], enforce_quotas=enforce_quotas)
+                    else:
+                        self._record_update(
+                            old_scope, size_change, enforce_quotas)
+                break
+            except IntegrityError:
+                # Another save took the slug; pick it again.
+                if attempt == 1:
+                    raise
+        self._loaded_scope = self._usage_scope()
+        bump_attachment_versions([self])
 
     def file_url(self):
         return self.file.url
@@ -275,6 +623,7 @@ class Attachment(models.Model):
         """
         return os.path.basename(self.file.name)
 
+    @instrument('attachment.copy')
     def copy(self, to_object, deepcopy=False, save_attachment=True):
         """
         Create a copy of this attachment that's attached to to_object instead
@@ -289,6 +638,8 @@ class Attachment(models.Model):
         copy.title = self.title
         copy.slug = self.slug
         copy.summary = self.summary
+        copy.file_size = self.file_size
+        copy.sha256 = self.sha256
         copy.attached_by_id = self.attached_by_id
 
         # Modify the generic FK so that it points to the 'to_object'
@@ -298,6 +649,7 @@ class Attachment(models.Model):
 
         # Handle empty files and shallow copies.
         if not deepcopy or not self.file:
+            copy.storage_tier = self.storage_tier
             copy.file = self.file
             if save_attachment:
                 copy.save()
@@ -306,6 +658,12 @@ class Attachment(models.Model):
         try:
             path = self.file.path
         except NotImplementedError:
+            # Only needed for remote storages, so imported on first use.
+            import shutil
+            import tempfile
+
+            from six.moves.urllib.request import urlopen
+
             # Not a local file, download it to copy it.
             # The file system backend doesn't support absolute paths. DL the
             # file.
@@ -326,3 +684,165 @@ class Attachment(models.Model):
             copy.save()
         local_f.close()
         return copy
+
+
+class QuotaExceeded(Exception):
+    """
+    Raised when adding to a usage counter would take it past its limit.
+    ``model`` is the counter's model and ``field`` the exceeded limit,
+    ``'count'`` or ``'size'``, of ``limit``.
+    """
+
+    def __init__(self, model, field, limit):
+        super(QuotaExceeded, self).__init__(model, field, limit)
+        self.model = model
+        self.field = field
+        self.limit = limit
+
+
+class AttachmentUsageManager(models.Manager):
+
+    def add(self, count, size, max_count=None, max_size=None, **lookup):
+        """
+        Atomically adds ``count`` attachments and ``size`` bytes to the
+        counter matching ``lookup``, creating it if needed.
+
+        The counter is only changed if it stays within ``max_count`` and
+        ``max_size``, checked by the same ``UPDATE``; otherwise
+        ``QuotaExceeded`` is raised.
+        """
+        if not count and not size:
+            return
+        queryset = self.filter(**lookup)
+        limited = queryset
+        if max_count is not None and count > 0:
+            limited = limited.filter(count__lte=max_count - count)
+        if max_size is not None and size > 0:
+            limited = limited.filter(size__lte=max_size - size)
+        changes = {'count': F('count') + count, 'size': F('size') + size}
+        if limited.update(**changes):
+            return
+
+        usage = queryset.values_list('count', 'size').first() or (0, 0)
+        if max_count is not None and count > 0 and \
+                usage[0] + count > max_count:
+            raise QuotaExceeded(self.model, 'count', max_count)
+        if max_size is not None and size > 0 and usage[1] + size > max_size:
+            raise QuotaExceeded(self.model, 'size', max_size)
+        usage, created = self.get_or_create(
+            defaults={'count': count, 'size': size},
+            **lookup
+        )
+        if not created:
+            # Created concurrently, or changed since the update.
+            self.add(count, size, max_count, max_size, **lookup)
+
+
+class AttachmentUsage(models.Model):
+    """
+    Number and total size of the attachments in some scope, maintained as
+    attachments come and go so quota checks don't need aggregates. The
+    ``reconcile_attachment_usage`` command repairs any drift.
+    """
+    count = models.IntegerField(_("count"), default=0)
+    size = models.BigIntegerField(_("size"), default=0)
+
+    objects = AttachmentUsageManager()
+
+    class Meta:
+        abstract = True
+
+
+class UserAttachmentUsage(AttachmentUsage):
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        verbose_name=_("user"),
+        related_name="attachment_usage",
+        on_delete=models.CASCADE,
+    )
+
+    class Meta:
+        verbose_name = _('user attachment usage')
+        verbose_name_plural = _('user attachment usage')
+
+
+class ObjectAttachmentUsage(AttachmentUsage):
+    content_type = models.ForeignKey(
+        ContentType,
+        on_delete=models.CASCADE,
+    )
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey("content_type", "object_id")
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+        verbose_name = _('object attachment usage')
+        verbose_name_plural = _('object attachment usage')
+
+
+def record_usage(attachments, count=1, size=None, enforce_quotas=False):
+    """
+    Adds ``count`` to the usage counters of the user and the object of each
+    of ``attachments``, along with ``size`` bytes or, by default, ``count``
+    times the attachment's file size.
+
+    With ``enforce_quotas``, the limits of the ATTACHMENT_USER_MAX_* and
+    ATTACHMENT_OBJECT_MAX_* settings are applied; see ``quotas``.
+    """
+    user_limits = object_limits = (None, None)
+    if enforce_quotas:
+        user_limits = (
+            getattr(settings, 'ATTACHMENT_USER_MAX_COUNT', None),
+            getattr(settings, 'ATTACHMENT_USER_MAX_SIZE', None),
+        )
+        object_limits = (
+            getattr(settings, 'ATTACHMENT_OBJECT_MAX_COUNT', None),
+            getattr(settings, 'ATTACHMENT_OBJECT_MAX_SIZE', None),
+        )
+
+    users = {}
+    objects = {}
+    for attachment in attachments:
+        added = (
+            count,
+            count * attachment.file_size if size is None else size,
+        )
+        for totals, key in (
+            (users, attachment.attached_by_id),
+            (objects, (attachment.content_type_id, attachment.object_id)),
+        ):
+            previous = totals.get(key, (0, 0))
+            totals[key] = (previous[0] + added[0], previous[1] + added[1])
+
+    for user_id, (added_count, added_size) in users.items():
+        UserAttachmentUsage.objects.add(
+            added_count, added_size, *user_limits, user_id=user_id)
+    for (content_type_id, object_id), (added_count, added_size) in \
+            objects.items():
+        ObjectAttachmentUsage.objects.add(
+            added_count,
+            added_size,
+            *object_limits,
+            content_type_id=content_type_id,
+            object_id=object_id,
+        )
+
+
+def bump_attachment_versions(attachments):
+    """
+    Invalidates the cached fragments of the objects of ``attachments``.
+    """
+    bump_versions(
+        (attachment.content_type_id, attachment.object_id)
+        for attachment in attachments
+    )
+
+
+def attachment_deleted(sender, instance, **kwargs):
+    if getattr(instance, '_usage_batched', False):
+        return
+    record_usage([instance], count=-1)
+    bump_attachment_versions([instance])
+
+
+post_delete.connect(attachment_deleted, sender=Attachment)
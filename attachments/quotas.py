@@ -0,0 +1,94 @@
+"""
+Attachment quotas, read from the usage counters.
+
+Limits come from these settings, each None (unlimited) by default:
+
+* ATTACHMENT_USER_MAX_COUNT / ATTACHMENT_USER_MAX_SIZE: attachments and
+  bytes per ``attached_by`` user.
+* ATTACHMENT_OBJECT_MAX_COUNT / ATTACHMENT_OBJECT_MAX_SIZE: attachments and
+  bytes per content object.
+
+``check_quota`` validates an upload up front. Concurrent uploads can all
+pass it, so the upload and edit views also save with
+``enforce_quotas=True``, which applies the limits in the same ``UPDATE``
+that counts the attachment or its new size.
+"""
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.template.defaultfilters import filesizeformat
+from django.utils.translation import gettext as _
+
+from attachments.models import ObjectAttachmentUsage, UserAttachmentUsage
+
+
+def _usage(queryset):
+    return queryset.values_list('count', 'size').first() or (0, 0)
+
+
+def _error(model, field, limit):
+    if model is UserAttachmentUsage:
+        count_message = _("You can't attach more than %(max)s files.")
+        size_message = _("Your attachments can't take more than %(max)s.")
+    else:
+        count_message = _(
+            "This object can't have more than %(max)s attachments.")
+        size_message = _(
+            "The attachments of this object can't take more than %(max)s.")
+    if field == 'count':
+        return ValidationError(count_message % {'max': limit})
+    return ValidationError(size_message % {'max': filesizeformat(limit)})
+
+
+def _check(model, usage, count, size, max_count, max_size):
+    used_count, used_size = usage
+    if max_count is not None and count > 0 and \
+            used_count + count > max_count:
+        raise _error(model, 'count', max_count)
+    if max_size is not None and size > 0 and used_size + size > max_size:
+        raise _error(model, 'size', max_size)
+
+
+def quota_error(exc):
+    """
+    Returns the ``ValidationError`` describing ``exc``, a
+    ``QuotaExceeded`` raised when saving an attachment.
+    """
+    return _error(exc.model, exc.field, exc.limit)
+
+
+def check_quota(user, content_object, size, count=1):
+    """
+    Raises ``ValidationError`` if attaching another file of ``size`` bytes
+    by ``user`` to ``content_object`` would exceed a quota.
+
+    Pass ``count=0`` to check a file growing by ``size`` bytes instead.
+    """
+    max_count = getattr(settings, 'ATTACHMENT_USER_MAX_COUNT', None)
+    max_size = getattr(settings, 'ATTACHMENT_USER_MAX_SIZE', None)
+    if user is not None and (max_count is not None or max_size is not None):
+        _check(
+            UserAttachmentUsage,
+            _usage(UserAttachmentUsage.objects.filter(user=user)),
+            count,
+            size,
+            max_count,
+            max_size,
+        )
+
+    max_count = getattr(settings, 'ATTACHMENT_OBJECT_MAX_COUNT', None)
+    max_size = getattr(settings, 'ATTACHMENT_OBJECT_MAX_SIZE', None)
+    if content_object is not None and (
+            max_count is not None or max_size is not None):
+        _check(
+            ObjectAttachmentUsage,
+            _usage(ObjectAttachmentUsage.objects.filter(
+                content_type=ContentType.objects.get_for_model(
+                    content_object),
+                object_id=content_object.pk,
+            )),
+            count,
+            size,
+            max_count,
+            max_size,
+        )
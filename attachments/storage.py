@@ -0,0 +1,50 @@
+"""
+Storage tiers for attachments.
+
+The ATTACHMENT_STORAGE_TIERS setting maps tier names to a callable (in the
+same string format as TEMPLATE_LOADERS) returning the storage of that
+tier, e.g.::
+
+    ATTACHMENT_STORAGE_TIERS = {
+        'cold': 'myproject.storages.ColdStorage',
+    }
+
+Attachments with an empty ``storage_tier`` use the storage of the file
+field, which is the default storage unless configured otherwise.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+
+from .utils import get_callable_from_string
+
+
+_storages = {}
+
+
+def _clear_storages(setting, **kwargs):
+    if setting == 'ATTACHMENT_STORAGE_TIERS':
+        _storages.clear()
+
+
+setting_changed.connect(_clear_storages)
+
+
+def get_tier_storage(tier, default=None):
+    """
+    Returns the storage for ``tier``, or ``default`` for the empty tier.
+    """
+    if not tier:
+        return default
+    try:
+        return _storages[tier]
+    except KeyError:
+        pass
+
+    tiers = getattr(settings, 'ATTACHMENT_STORAGE_TIERS', {})
+    if tier not in tiers:
+        raise ImproperlyConfigured(
+            'Storage tier "%s" is not in ATTACHMENT_STORAGE_TIERS' % tier,
+        )
+    storage = _storages[tier] = get_callable_from_string(tiers[tier])()
+    return storage
@@ -1,14 +1,58 @@
 from django import template
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
+
+from attachments.instrumentation import instrument
+from attachments.versions import get_version
 
 register = template.Library()
 
 
+def fragment_key(obj, user):
+    """
+    The cache key of the ``attachments`` fragment of ``obj`` as seen by
+    ``user``; it changes whenever the attachments of ``obj`` do.
+    """
+    content_type_id = ContentType.objects.get_for_model(obj).pk
+    return 'attachments:fragment:%s:%s:%s:%s:%s' % (
+        content_type_id,
+        obj.pk,
+        get_version(content_type_id, obj.pk),
+        getattr(user, 'pk', None),
+        get_language(),
+    )
+
+
+@instrument('tag.attachments')
 def attachments(context, obj):
-    return {
-        'object': obj,
-        'request': context['request'],
-        'user': context['user'],
-    }
+    """
+    Renders ``attachments/attachments.html`` for ``obj``.
+
+    Setting ATTACHMENT_FRAGMENT_CACHE_TIMEOUT (0, off, by default) caches it
+    for that many seconds in the ATTACHMENT_FRAGMENT_CACHE cache, which
+    must be shared by all processes, such as memcached or Redis: changes
+    made by one process only invalidate the fragments in its cache. Changes
+    made with ``QuerySet.update()`` don't invalidate them at all.
+    """
+    user = context.get('user')
+    timeout = getattr(settings, 'ATTACHMENT_FRAGMENT_CACHE_TIMEOUT', 0)
+    cache = caches[getattr(settings, 'ATTACHMENT_FRAGMENT_CACHE', 'default')]
+
+    key = fragment_key(obj, user) if timeout else None
+    html = cache.get(key) if key else None
+    if html is None:
+        html = render_to_string('attachments/attachments.html', {
+            'object': obj,
+            'request': context.get('request'),
+            'user': user,
+        })
+        if key:
+            cache.set(key, html, timeout)
+    return mark_safe(html)
 
 
-register.inclusion_tag('attachments/attachments.html', takes_context=True)(attachments)  # noqa E501
+register.simple_tag(takes_context=True)(attachments)
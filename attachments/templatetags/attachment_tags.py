@@ -1,6 +1,9 @@
 from django import template
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.urls import reverse
+from django.core.signals import setting_changed
+from django.urls import get_script_prefix, get_urlconf, reverse
+from django.utils.translation import get_language
 
 from attachments.models import Attachment
 
@@ -11,29 +14,90 @@ def get_contenttype_kwargs(content_object):
     """
     kwargs = {
         'content_type': ContentType.objects.get_for_model(content_object).id,
-        'object_id': getattr(
-            content_object,
-            'pk',
-            getattr(content_object, 'id'),
-        ),
+        'object_id': content_object.pk,
     }
     return kwargs
 
 
+# A stand-in object id which can't clash with a content type id.
+_OBJECT_ID_PLACEHOLDER = '9' * 20
+_url_templates = {}
+
+
+def _clear_url_templates(**kwargs):
+    _url_templates.clear()
+
+
+setting_changed.connect(_clear_url_templates)
+
+
+def new_attachment_url_template(content_type_id):
+    """
+    Returns the ``(prefix, suffix)`` around the object id in the
+    ``attachment_new`` URL of a content type, resolving the route only once
+    per content type, URLconf, script prefix and language (for
+    ``i18n_patterns``).
+    """
+    key = (
+        get_urlconf() or settings.ROOT_URLCONF,
+        get_script_prefix(),
+        get_language(),
+        content_type_id,
+    )
+    try:
+        return _url_templates[key]
+    except KeyError:
+        pass
+    url = reverse('attachment_new', kwargs={
+        'content_type': content_type_id,
+        'object_id': _OBJECT_ID_PLACEHOLDER,
+    })
+    prefix, suffix = url.rsplit(_OBJECT_ID_PLACEHOLDER, 1)
+    _url_templates[key] = prefix, suffix
+    return prefix, suffix
+
+
 def new_attachment_url(content_object):
-    kwargs = get_contenttype_kwargs(content_object)
-    return reverse('attachment_new', kwargs=kwargs)
+    prefix, suffix = new_attachment_url_template(
+        ContentType.objects.get_for_model(content_object).id)
+    return '%s%s%s' % (prefix, content_object.pk, suffix)
+
+
+def new_attachment_urls(content_objects):
+    """
+    Returns ``(object, url)`` pairs for ``content_objects``, for use as
+    ``{% new_attachment_urls objects as pairs %}`` on list pages.
+    """
+    templates = {}
+    pairs = []
+    for content_object in content_objects:
+        model = content_object.__class__
+        if model not in templates:
+            templates[model] = new_attachment_url_template(
+                ContentType.objects.get_for_model(content_object).id)
+        prefix, suffix = templates[model]
+        pairs.append((
+            content_object,
+            '%s%s%s' % (prefix, content_object.pk, suffix),
+        ))
+    return pairs
 
 
 class ObjectAttachmentsNode(template.Node):
-    def __init__(self, content_object, context_name, order_by):
+    def __init__(self, content_object, context_name, order_by,
+                 summary_view=False):
         self.content_object = template.Variable(content_object)
         self.context_name = context_name
         self.order_by = order_by
+        self.summary_view = summary_view
 
     def render(self, context):
         content_object = self.content_object.resolve(context)
-        attachments = Attachment.objects.attachments_for_object(content_object)
+        attachments = Attachment.objects.attachments_for_object(
+            content_object,
+        ).select_related('attached_by').instrumented('tag.get_attachments')
+        if self.summary_view:
+            attachments = attachments.summary_view()
         if self.order_by:
             attachments = attachments.order_by(self.order_by)
         context[self.context_name] = attachments
@@ -42,8 +106,13 @@ class ObjectAttachmentsNode(template.Node):
 
 def do_get_attachments(parser, token):
     bits = token.contents.split()
-    error_string = "%r tag must be of format {%% get_attachments for OBJECT as CONTEXT_VARIABLE %%}" % bits[0]  # noqa
+    error_string = "%r tag must be of format {%% get_attachments for OBJECT as CONTEXT_VARIABLE [order_by FIELD] [summary] %%}" % bits[0]  # noqa
     order_by = None
+    # Only a trailing word beyond the named arguments is the flag, so
+    # ``as summary`` and ``order_by summary`` keep their meaning.
+    summary_view = len(bits) in (6, 8) and bits[-1] == 'summary'
+    if summary_view:
+        bits = bits[:-1]
     if len(bits) == 5:
         try:
             tag, word_for, content_object, word_as, context_name = bits
@@ -53,9 +122,11 @@ def do_get_attachments(parser, token):
         tag, word_for, content_object, word_as, context_name, word_order_by, order_by = bits  # noqa
     else:
         raise template.TemplateSyntaxError(error_string)
-    return ObjectAttachmentsNode(content_object, context_name, order_by)
+    return ObjectAttachmentsNode(
+        content_object, context_name, order_by, summary_view)
 
 
 register = template.Library()
 register.simple_tag(new_attachment_url)
+register.simple_tag(new_attachment_urls)
 register.tag('get_attachments', do_get_attachments)
@@ -1,16 +1,60 @@
 from contextlib import contextmanager
+from io import BytesIO, StringIO
 from datetime import datetime
 from tempfile import NamedTemporaryFile
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+from unittest import mock
 
+from django import forms
+from django.contrib import admin
+from django.contrib.auth.models import Permission
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.conf import settings
+from django.core.cache import cache
 from django.core.files import File
-from django.urls import reverse
+from django.core.handlers.wsgi import WSGIRequest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.conf.urls.i18n import i18n_patterns
+from django.urls import include, path, reverse
 from django.db import models
-from django.test import TestCase
+from django.template import Context, Template
+from django.test import (
+    Client,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    override_settings,
+)
+from django.utils import translation
 from django.utils.encoding import force_str
 
-from attachments.models import Attachment, get_attachment_dir
+from attachments import instrumentation
+from attachments.admin import EstimatedCountPaginator
+from attachments.forms import AttachmentEditForm, AttachmentForm
+from attachments.management.commands.reconcile_attachment_usage import (
+    Command as ReconcileCommand,
+)
+from attachments.models import (
+    Attachment,
+    ObjectAttachmentUsage,
+    QuotaExceeded,
+    UserAttachmentUsage,
+    get_attachment_dir,
+)
+from attachments.throttling import acquire_upload_slot, release_upload_slot
+from attachments.utils import run_in_background
+from attachments.views import new_attachment
 
 
 User = get_user_model()
@@ -25,6 +69,21 @@ class TestModel(models.Model):
     date = models.DateTimeField(default=datetime.now)
 
 
+# A URLconf with language prefixes, for the tests using it as ROOT_URLCONF.
+urlpatterns = i18n_patterns(path('', include('attachments.urls')))
+
+
+def run_inline(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+COLD_STORAGE_DIR = tempfile.mkdtemp()
+
+
+def cold_storage():
+    return FileSystemStorage(location=COLD_STORAGE_DIR)
+
+
 class TestAttachmentCopying(TestCase):
     def setUp(self):
         self.bob = User.objects.create(username="bob")
@@ -88,6 +147,27 @@ class TestAttachmentCopying(TestCase):
         r = self.client.get(url)
         self.assertEqual(r.status_code, 200)
 
+    def test_download_attachments_streams_zip(self):
+        self.create_attachment(self.tm, attached_by=self.bob, title='One')
+        self.create_attachment(self.tm, attached_by=self.bob, title='Two')
+        url = reverse(
+            'attachment_download_all',
+            kwargs={
+                'content_type': self.content_type.pk,
+                'object_id': self.tm.pk,
+            },
+        )
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.streaming)
+        self.assertEqual(r['Content-Type'], 'application/zip')
+
+        archive = zipfile.ZipFile(BytesIO(b''.join(r.streaming_content)))
+        self.assertEqual(len(archive.namelist()), 2)
+        self.assertEqual(len(set(archive.namelist())), 2)
+        for name in archive.namelist():
+            self.assertEqual(archive.read(name), b'some test text')
+
     def test_delete_attachment(self):
         attachment = self.create_attachment(
             self.tm,
@@ -117,6 +197,84 @@ class TestAttachmentCopying(TestCase):
         r = self.client.get(url)
         self.assertEqual(r.status_code, 200)
 
+    @override_settings(
+        ATTACHMENT_THROTTLE_RATE=0.001, ATTACHMENT_THROTTLE_BURST=2)
+    def test_views_are_rate_limited(self):
+        cache.clear()
+        url = reverse(
+            'attachment_list',
+            kwargs={
+                'content_type': self.content_type.pk,
+                'object_id': self.tm.pk,
+            },
+        )
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 429)
+        self.assertIn('Retry-After', r)
+
+    @override_settings(
+        ATTACHMENT_MAX_UPLOAD_SIZE=100, ATTACHMENT_MAX_CONCURRENT_UPLOADS=0)
+    def test_upload_limits(self):
+        cache.clear()
+        url = reverse(
+            'attachment_new',
+            kwargs={
+                'content_type': self.content_type.pk,
+                'object_id': self.tm.pk,
+            },
+        )
+        # Refused before CsrfViewMiddleware reads the body.
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.bob)
+        with mock.patch.object(
+                WSGIRequest, '_load_post_and_files') as load:
+            r = client.post(url, {
+                'file': SimpleUploadedFile('big.txt', b'x' * 200),
+            })
+            self.assertEqual(r.status_code, 413)
+            r = client.post(url, {'title': 'x'})
+            self.assertEqual(r.status_code, 429)
+        self.assertFalse(load.called)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        # Without the middleware the views still apply the limits.
+        middleware = [
+            name for name in settings.MIDDLEWARE
+            if name != 'attachments.middleware.UploadLimitMiddleware'
+        ]
+        with self.settings(MIDDLEWARE=middleware):
+            r = self.client.post(url, {
+                'file': SimpleUploadedFile('big.txt', b'x' * 200),
+            })
+            self.assertEqual(r.status_code, 413)
+            r = self.client.post(url, {'title': 'x'})
+            self.assertEqual(r.status_code, 429)
+        self.assertEqual(cache.get('attachments:uploads-in-flight'), 0)
+
+    def test_upload_slot_counter_stays_positive(self):
+        cache.clear()
+        self.assertTrue(acquire_upload_slot(1))
+        # The counter expired and restarted while the upload was running.
+        cache.set('attachments:uploads-in-flight', 0)
+        release_upload_slot()
+        self.assertEqual(cache.get('attachments:uploads-in-flight'), 0)
+        self.assertTrue(acquire_upload_slot(1))
+        self.assertFalse(acquire_upload_slot(1))
+
+    def test_new_attachment_with_custom_form(self):
+        class TitleForm(forms.ModelForm):
+            class Meta:
+                model = Attachment
+                fields = ('title', 'file')
+
+        request = RequestFactory().post('/', {'title': 'No file'})
+        request.user = self.bob
+        r = new_attachment(
+            request, self.content_type.pk, self.tm.pk, form_cls=TitleForm)
+        self.assertEqual(r.status_code, 200)
+
     def test_GET_edit_attachment(self):
         attachment = self.create_attachment(
             self.tm,
@@ -140,3 +298,601 @@ class TestAttachmentCopying(TestCase):
             title='Foo bar title',
         )
         self.assertEqual(force_str(attachment), 'Foo bar title')
+
+    def test_slugs_are_unique_per_object(self):
+        first = self.create_attachment(
+            self.tm, attached_by=self.bob, title='Same title')
+        second = self.create_attachment(
+            self.tm, attached_by=self.bob, title='Same title')
+        other = self.create_attachment(
+            self.tm2, attached_by=self.bob, title='Same title')
+        self.assertEqual(first.slug, 'same-title')
+        self.assertEqual(second.slug, 'same-title-2')
+        self.assertEqual(other.slug, 'same-title')
+
+        # Re-saving keeps the slug instead of picking a new one.
+        second.summary = 'Changed'
+        second.save()
+        self.assertEqual(second.slug, 'same-title-2')
+
+    def test_long_slugs_keep_suffix_within_max_length(self):
+        title = 'x' * 200
+        first = self.create_attachment(
+            self.tm, attached_by=self.bob, title=title)
+        second = self.create_attachment(
+            self.tm, attached_by=self.bob, title=title)
+        self.assertEqual(len(first.slug), 50)
+        self.assertEqual(second.slug, 'x' * 48 + '-2')
+
+    def test_save_retries_slug_taken_concurrently(self):
+        self.create_attachment(self.tm, attached_by=self.bob, title='Race')
+        set_slugs = Attachment.objects.set_slugs
+        calls = []
+
+        def racing_set_slugs(attachments):
+            # The first pick misses the slug taken by a concurrent save.
+            calls.append(attachments)
+            if len(calls) > 1:
+                return set_slugs(attachments)
+            for attachment in attachments:
+                attachment.slug = 'race'
+
+        with mock.patch.object(
+                Attachment.objects, 'set_slugs', racing_set_slugs):
+            attachment = Attachment(
+                content_object=self.tm, attached_by=self.bob, title='Race')
+            attachment.save()
+        self.assertEqual(attachment.slug, 'race-2')
+        self.assertEqual(len(calls), 2)
+
+    def test_bulk_create_assigns_unique_slugs(self):
+        self.create_attachment(
+            self.tm, attached_by=self.bob, title='Report')
+        # One slug lookup, the insert and one update per usage counter,
+        # inside a savepoint.
+        with self.assertNumQueries(6):
+            created = Attachment.objects.bulk_create([
+                Attachment(
+                    content_object=self.tm,
+                    attached_by=self.bob,
+                    title='Report',
+                    file='attachments/report.txt',
+                )
+                for _ in range(3)
+            ])
+        self.assertEqual(
+            [attachment.slug for attachment in created],
+            ['report-2', 'report-3', 'report-4'],
+        )
+
+    def test_copy_attachments_assigns_slugs_in_bulk(self):
+        self.create_attachment(self.tm, attached_by=self.bob, title='A')
+        self.create_attachment(self.tm, attached_by=self.bob, title='A')
+        copies = Attachment.objects.copy_attachments(self.tm, self.tm2)
+        self.assertEqual(
+            sorted(attachment.slug for attachment in copies),
+            ['a', 'a-2'],
+        )
+        self.assertEqual(
+            Attachment.objects.attachments_for_object(self.tm2).count(), 2)
+
+    def test_usage_for_queryset(self):
+        self.create_attachment(self.tm, attached_by=self.bob, title='One')
+        self.create_attachment(self.tm2, attached_by=self.bob, title='Two')
+        usage = Attachment.objects.usage_for_queryset(
+            TestModel.objects.filter(name='Test2'))
+        self.assertEqual([attachment.title for attachment in usage], ['Two'])
+
+    def test_instrumentation_records_queries_and_bytes(self):
+        with instrumentation.collect() as sink:
+            attachment = self.create_attachment(
+                self.tm, attached_by=self.bob, title='Measured')
+            list(attachment.file.chunks())
+            attachment.file.close()
+            Attachment.objects.copy_attachments(self.tm, self.tm2)
+            attachments = Attachment.objects.attachments_for_object(self.tm2)
+            reported = len(sink.events)
+            list(attachments)
+            self.assertEqual(
+                [(event.name, event.queries)
+                 for event in sink.events[reported:]],
+                [('manager.attachments_for_object', 1)],
+            )
+
+        events = dict((event.name, event) for event in sink.events)
+        self.assertEqual(events['storage.write'].bytes, len('some test text'))
+        self.assertEqual(events['storage.read'].bytes, len('some test text'))
+        self.assertGreaterEqual(events['manager.create_for_object'].queries, 2)
+        self.assertIn('attachment.copy', events)
+        self.assertGreater(events['manager.copy_attachments'].queries, 0)
+
+    @override_settings(ATTACHMENT_INSTRUMENTATION_SINKS=[
+        'attachments.instrumentation.logging_sink',
+    ])
+    def test_instrumentation_sinks_from_settings(self):
+        with self.assertLogs('attachments.instrumentation', 'DEBUG') as logs:
+            Attachment.objects.usage_for_queryset(TestModel.objects.all())
+        self.assertIn('manager.usage_for_queryset took', logs.output[0])
+
+    @override_settings(ATTACHMENT_STORAGE_TIERS={
+        'cold': 'attachments.tests.cold_storage',
+    })
+    def test_migrate_attachment_storage(self):
+        self.addCleanup(shutil.rmtree, COLD_STORAGE_DIR, True)
+        attachment = self.create_attachment(self.tm, attached_by=self.bob)
+        old_path = attachment.file.path
+        file_name = attachment.file_name()
+        # Same name and size but other content, which one_folder maps to
+        # the same target name.
+        other = Attachment.objects.create_for_object(
+            self.tm2, attached_by=self.bob)
+        with self.open('some test TEXT') as f:
+            other.file.save('models.py', f)
+        # A newer shallow copy stays behind and keeps the old file in use.
+        shared = other.copy(self.tm)
+        cutoff = datetime(2000, 1, 1)
+        Attachment.objects.exclude(pk=shared.pk).update(
+            attached_timestamp=cutoff)
+        checkpoint = os.path.join(COLD_STORAGE_DIR, 'checkpoint.json')
+
+        call_command(
+            'migrate_attachment_storage',
+            to_tier='cold',
+            scheme='attachments.directory_schemes.one_folder',
+            older_than=1,
+            checkpoint=checkpoint,
+            delete_source=True,
+            stdout=StringIO(),
+        )
+
+        attachment = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual(attachment.storage_tier, 'cold')
+        self.assertEqual(
+            attachment.file.name, os.path.join('attachments', file_name))
+        self.assertTrue(attachment.file.path.startswith(COLD_STORAGE_DIR))
+        with attachment.file.open('r') as f:
+            self.assertEqual(f.read(), 'some test text')
+        self.assertFalse(os.path.exists(old_path))
+        self.assertFalse(os.path.exists(checkpoint))
+
+        other = Attachment.objects.get(pk=other.pk)
+        self.assertEqual(other.storage_tier, 'cold')
+        self.assertNotEqual(other.file.name, attachment.file.name)
+        with other.file.open('r') as f:
+            self.assertEqual(f.read(), 'some test TEXT')
+        shared = Attachment.objects.get(pk=shared.pk)
+        self.assertEqual(shared.storage_tier, '')
+        with shared.file.open('r') as f:
+            self.assertEqual(f.read(), 'some test TEXT')
+
+    @override_settings(ATTACHMENT_STORAGE_TIERS={
+        'cold': 'attachments.tests.cold_storage',
+    })
+    def test_migrate_attachment_storage_retries_failures(self):
+        self.addCleanup(shutil.rmtree, COLD_STORAGE_DIR, True)
+        attachment = self.create_attachment(self.tm, attached_by=self.bob)
+        missing = Attachment.objects.create_for_object(
+            self.tm2, attached_by=self.bob, file='attachments/missing.txt')
+        self.addCleanup(missing.file.storage.delete, missing.file.name)
+        checkpoint = os.path.join(COLD_STORAGE_DIR, 'checkpoint.json')
+        options = {
+            'to_tier': 'cold',
+            'checkpoint': checkpoint,
+            'stdout': StringIO(),
+            'stderr': StringIO(),
+        }
+
+        call_command('migrate_attachment_storage', **options)
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f)['failed'], [missing.pk])
+        self.assertEqual(
+            Attachment.objects.get(pk=attachment.pk).storage_tier, 'cold')
+
+        with self.open() as f:
+            missing.file.storage.save(missing.file.name, f)
+        call_command('migrate_attachment_storage', **options)
+        self.assertEqual(
+            Attachment.objects.get(pk=missing.pk).storage_tier, 'cold')
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_export_and_import_attachments(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        kept = self.create_attachment(
+            self.tm, attached_by=self.bob, title='Kept')
+        removed = self.create_attachment(
+            self.tm2, attached_by=self.bob, title='Removed', summary='S')
+        removed_name = removed.file.name
+        self.assertEqual(
+            kept.sha256, hashlib.sha256(b'some test text').hexdigest())
+        # Untitled attachments used to get the slug "none".
+        Attachment.objects.filter(pk=removed.pk).update(
+            title=None, slug='none')
+        call_command('export_attachments', directory, stdout=StringIO())
+        manifest = os.path.join(directory, 'attachments.ndjson')
+        with open(manifest) as f:
+            lines = f.readlines()
+        with open(manifest, 'a') as f:
+            f.write(lines[-1])
+
+        removed.file.delete(save=False)
+        removed.delete()
+        out = StringIO()
+        call_command('import_attachments', directory, stdout=out)
+        self.assertIn('Imported 1 attachments (1 files copied), skipped 2',
+                      out.getvalue())
+
+        imported = Attachment.objects.get(object_id=self.tm2.pk)
+        self.assertEqual(imported.slug, 'none')
+        self.assertEqual(imported.summary, 'S')
+        self.assertEqual(imported.attached_by, self.bob)
+        self.assertEqual(imported.file.name, removed_name)
+        with imported.file.open('r') as f:
+            self.assertEqual(f.read(), 'some test text')
+        self.assertEqual(
+            Attachment.objects.filter(object_id=kept.object_id).count(), 1)
+
+        self.assertEqual(imported.sha256, kept.sha256)
+
+        # Compared by the recorded digests, without reading stored files.
+        out = StringIO()
+        with mock.patch.object(FileSystemStorage, 'open') as opened:
+            call_command('import_attachments', directory, stdout=out)
+        self.assertFalse(opened.called)
+        self.assertIn('Imported 0 attachments (0 files copied), skipped 3',
+                      out.getvalue())
+
+    def test_usage_counters(self):
+        first = self.create_attachment(self.tm, attached_by=self.bob)
+        self.create_attachment(self.tm, attached_by=self.bob)
+        first.delete()
+        usage = UserAttachmentUsage.objects.get(user=self.bob)
+        self.assertEqual((usage.count, usage.size), (1, 14))
+        usage = ObjectAttachmentUsage.objects.get(object_id=self.tm.pk)
+        self.assertEqual((usage.count, usage.size), (1, 14))
+
+        UserAttachmentUsage.objects.update(count=7, size=0)
+        ObjectAttachmentUsage.objects.all().delete()
+        call_command('reconcile_attachment_usage', stdout=StringIO())
+        usage = UserAttachmentUsage.objects.get(user=self.bob)
+        self.assertEqual((usage.count, usage.size), (1, 14))
+        usage = ObjectAttachmentUsage.objects.get(object_id=self.tm.pk)
+        self.assertEqual((usage.count, usage.size), (1, 14))
+
+        self.create_attachment(self.tm, attached_by=self.bob)
+        self.create_attachment(self.tm, attached_by=self.bob)
+        # One select and one delete, then one update per counter, inside a
+        # transaction: no queries per deleted attachment.
+        with self.assertNumQueries(6):
+            Attachment.objects.attachments_for_object(self.tm).delete()
+        usage = UserAttachmentUsage.objects.get(user=self.bob)
+        self.assertEqual((usage.count, usage.size), (0, 0))
+
+        # Uploads counted while reconciling aren't overwritten.
+        self.create_attachment(self.tm, attached_by=self.bob)
+        UserAttachmentUsage.objects.update(count=7)
+        fix_batch = ReconcileCommand.fix_batch
+
+        def upload_then_fix(command, *args):
+            self.create_attachment(self.tm2, attached_by=self.bob)
+            return fix_batch(command, *args)
+
+        with mock.patch.object(ReconcileCommand, 'fix_batch',
+                               upload_then_fix):
+            call_command('reconcile_attachment_usage', stdout=StringIO())
+        count = Attachment.objects.filter(attached_by=self.bob).count()
+        self.assertGreater(count, 1)
+        usage = UserAttachmentUsage.objects.get(user=self.bob)
+        self.assertEqual((usage.count, usage.size), (count, count * 14))
+
+    def test_usage_counters_follow_reassignment(self):
+        alice = User.objects.create(username='alice')
+        attachment = self.create_attachment(self.tm, attached_by=self.bob)
+        attachment = Attachment.objects.get(pk=attachment.pk)
+        attachment.attached_by = alice
+        attachment.object_id = self.tm2.pk
+        attachment.save()
+
+        def usage(model, **lookup):
+            return model.objects.filter(**lookup).values_list(
+                'count', 'size').get()
+
+        self.assertEqual(usage(UserAttachmentUsage, user=self.bob), (0, 0))
+        self.assertEqual(usage(UserAttachmentUsage, user=alice), (1, 14))
+        self.assertEqual(
+            usage(ObjectAttachmentUsage, object_id=self.tm.pk), (0, 0))
+        self.assertEqual(
+            usage(ObjectAttachmentUsage, object_id=self.tm2.pk), (1, 14))
+        attachment.delete()
+        self.assertEqual(usage(UserAttachmentUsage, user=alice), (0, 0))
+
+    @override_settings(
+        ATTACHMENT_OBJECT_MAX_COUNT=1, ATTACHMENT_USER_MAX_SIZE=20)
+    def test_quotas(self):
+        def form(text):
+            return AttachmentForm(
+                {'title': 'Quota', 'attached_timestamp': '2020-01-01'},
+                {'file': SimpleUploadedFile('quota.txt', text)},
+                content_object=self.tm,
+                user=self.bob,
+            )
+
+        self.assertFalse(form(b'x' * 21).is_valid())
+        self.assertTrue(form(b'x' * 10).is_valid())
+        self.create_attachment(self.tm, attached_by=self.bob)
+        with self.assertNumQueries(2):
+            self.assertFalse(form(b'x').is_valid())
+
+        # Saving enforces the quota too, for uploads validated concurrently.
+        attachment = Attachment(
+            content_object=self.tm2, attached_by=self.bob, file_size=5)
+        attachment.save(enforce_quotas=True)
+        attachment = Attachment(
+            content_object=self.tm2, attached_by=self.bob, file_size=1)
+        with self.assertRaises(QuotaExceeded) as raised:
+            attachment.save(enforce_quotas=True)
+        self.assertEqual(
+            (raised.exception.model, raised.exception.field),
+            (ObjectAttachmentUsage, 'count'),
+        )
+        self.assertEqual(
+            Attachment.objects.attachments_for_object(self.tm2).count(), 1)
+        usage = UserAttachmentUsage.objects.get(user=self.bob)
+        self.assertEqual((usage.count, usage.size), (2, 19))
+
+        url = reverse('attachment_new', kwargs={
+            'content_type': self.content_type.pk,
+            'object_id': self.tm2.pk,
+        })
+        with mock.patch('attachments.forms.check_quota'):
+            r = self.client.post(url, {
+                'title': 'Late',
+                'attached_timestamp': '2020-01-01',
+                'file': SimpleUploadedFile('late.txt', b'x'),
+            })
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.context['form'].errors['file'])
+        self.assertFalse(Attachment.objects.filter(title='Late').exists())
+
+    @override_settings(ATTACHMENT_USER_MAX_SIZE=20)
+    def test_edit_quotas(self):
+        attachment = self.create_attachment(self.tm, attached_by=self.bob)
+        with self.open('x' * 5) as f:
+            attachment.file.save('small.txt', f)
+        old_name = attachment.file.name
+
+        form = AttachmentEditForm(
+            {'title': 'Big', 'attached_timestamp': '2020-01-01'},
+            {'file': SimpleUploadedFile('big.txt', b'x' * 1000)},
+            instance=attachment,
+            user=self.bob,
+        )
+        self.assertFalse(form.is_valid())
+        self.assertIn('file', form.errors)
+
+        with self.open('x' * 1000) as f:
+            attachment.file.save('big.txt', f, save=False)
+        with self.assertRaises(QuotaExceeded):
+            attachment.save(enforce_quotas=True)
+        attachment.file.delete(save=False)
+        attachment = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual(attachment.file.name, old_name)
+
+        url = reverse('attachment_edit', kwargs={
+            'attachment_id': attachment.pk,
+        })
+        with mock.patch('attachments.forms.check_quota'):
+            r = self.client.post(url, {
+                'title': 'Big',
+                'attached_timestamp': '2020-01-01',
+                'file': SimpleUploadedFile('big.txt', b'x' * 1000),
+            })
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.context['form'].errors['file'])
+        attachment = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual(attachment.file.name, old_name)
+        self.assertTrue(attachment.file.storage.exists(old_name))
+        usage = UserAttachmentUsage.objects.get(user=self.bob)
+        self.assertEqual((usage.count, usage.size), (1, 5))
+
+    def test_attachments_tag_fragment_is_cached(self):
+        cache.clear()
+        self.create_attachment(self.tm, attached_by=self.bob, title='First')
+        tpl = Template('{% load attachment_inclusion_tag %}'
+                       '{% attachments object %}')
+        context = {'object': self.tm, 'user': self.bob, 'request': None}
+
+        # Off unless configured.
+        tpl.render(Context(context))
+        with self.assertNumQueries(1):
+            tpl.render(Context(context))
+
+        with self.settings(ATTACHMENT_FRAGMENT_CACHE_TIMEOUT=300):
+            with self.assertNumQueries(1):
+                html = tpl.render(Context(context))
+            self.assertIn('First', html)
+            self.assertIn('>bob<', html)
+            with self.assertNumQueries(0):
+                self.assertEqual(tpl.render(Context(context)), html)
+
+            self.create_attachment(
+                self.tm, attached_by=self.bob, title='Second')
+            self.assertIn('Second', tpl.render(Context(context)))
+
+    def test_new_attachment_urls(self):
+        tpl = Template(
+            '{% load attachment_tags %}'
+            '{% new_attachment_urls objects as pairs %}'
+            '{% for object, url in pairs %}{{ url }} {% endfor %}'
+            '{% new_attachment_url first %}'
+        )
+        expected = [
+            reverse('attachment_new', kwargs={
+                'content_type': self.content_type.pk,
+                'object_id': obj.pk,
+            })
+            for obj in (self.tm, self.tm2, self.tm)
+        ]
+        with self.assertNumQueries(0):
+            html = tpl.render(Context({
+                'objects': [self.tm, self.tm2],
+                'first': self.tm,
+            }))
+        self.assertEqual(html.split(), expected)
+
+    @override_settings(ROOT_URLCONF='attachments.tests')
+    def test_new_attachment_url_per_language(self):
+        tpl = Template(
+            '{% load attachment_tags %}{% new_attachment_url object %}')
+        for language in ('en', 'de'):
+            with translation.override(language):
+                self.assertEqual(
+                    tpl.render(Context({'object': self.tm})),
+                    reverse('attachment_new', kwargs={
+                        'content_type': self.content_type.pk,
+                        'object_id': self.tm.pk,
+                    }),
+                )
+
+    def test_summary_view(self):
+        self.create_attachment(
+            self.tm, attached_by=self.bob, title='Short', summary='x' * 1000)
+        tpl = Template(
+            '{% load attachment_tags %}'
+            '{% get_attachments for object as attachments summary %}'
+            '{% for a in attachments %}'
+            '{{ a.title }} {{ a.file_url }} {{ a.attached_timestamp }} '
+            '{{ a.attached_by }}'
+            '{% endfor %}'
+        )
+        with self.assertNumQueries(1):
+            html = tpl.render(Context({'object': self.tm}))
+        self.assertIn('Short', html)
+        self.assertIn('bob', html)
+
+        attachment = Attachment.objects.attachments_for_object(
+            self.tm).summary_view().get()
+        self.assertEqual(
+            attachment.get_deferred_fields(),
+            set([
+                'content_type_id', 'object_id', 'summary', 'file_size',
+                'sha256',
+            ]),
+        )
+
+        # "summary" is still usable as a variable name or ordering field.
+        tpl = Template(
+            '{% load attachment_tags %}'
+            '{% get_attachments for object as summary %}'
+            '{% get_attachments for object as ordered order_by summary %}'
+            '{{ summary.0.summary }} {{ ordered.0.summary }}'
+        )
+        html = tpl.render(Context({'object': self.tm}))
+        self.assertEqual(html, '%s %s' % ('x' * 1000, 'x' * 1000))
+
+    @override_settings(
+        ATTACHMENT_BACKGROUND_RUNNER='attachments.tests.run_inline')
+    def test_background_batched_delete(self):
+        attachments = [
+            self.create_attachment(self.tm, attached_by=self.bob)
+            for _ in range(3)
+        ]
+        pks = [attachment.pk for attachment in attachments]
+        query = pickle.loads(pickle.dumps(
+            Attachment.objects.filter(pk__in=pks).query))
+        run_in_background(
+            Attachment.objects.delete_in_batches, query, batch_size=2)
+        self.assertFalse(Attachment.objects.filter(pk__in=pks).exists())
+
+    def test_recompute_metadata(self):
+        attachment = self.create_attachment(
+            self.tm, attached_by=self.bob, title='Old')
+        Attachment.objects.filter(pk=attachment.pk).update(
+            title='New title')
+        Attachment.objects.recompute_metadata(
+            Attachment.objects.filter(pk=attachment.pk))
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.slug, 'new-title')
+
+    def test_admin_actions_need_permissions(self):
+        viewer = User.objects.create(username='viewer', is_staff=True)
+        viewer.user_permissions.add(Permission.objects.get(
+            content_type=ContentType.objects.get_for_model(Attachment),
+            codename='view_attachment',
+        ))
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(pk=viewer.pk)
+        model_admin = admin.site._registry[Attachment]
+        actions = model_admin.get_actions(request)
+        self.assertNotIn('delete_in_background', actions)
+        self.assertNotIn('recompute_metadata', actions)
+
+    def test_admin_paginator_caches_count(self):
+        cache.clear()
+        self.create_attachment(self.tm, attached_by=self.bob)
+        queryset = Attachment.objects.filter(object_id=self.tm.pk)
+        self.assertEqual(EstimatedCountPaginator(queryset, 10).count, 1)
+        self.create_attachment(self.tm, attached_by=self.bob)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                EstimatedCountPaginator(queryset, 10).count, 1)
+
+
+IMPORT_SCRIPT = """
+import django
+from django.conf import settings
+
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3'}},
+    INSTALLED_APPS=[
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'attachments',
+    ],
+)
+django.setup()
+
+import attachments.urls
+"""
+
+
+class TestImportTime(SimpleTestCase):
+    """
+    Guards the cold-start cost of the app with ``python -X importtime``.
+    The budget can be tuned with ATTACHMENTS_IMPORT_BUDGET_US.
+    """
+
+    def import_times(self):
+        """
+        Returns the cumulative import time, in microseconds, of every module
+        imported by IMPORT_SCRIPT that wasn't imported by another module.
+        """
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            self_us, cumulative_us, name = line[12:].split('|')
+            if self_us.strip().isdigit():
+                times[name.rstrip()] = int(cumulative_us)
+        return times
+
+    def test_import_has_no_deferred_dependencies(self):
+        names = [name.strip() for name in self.import_times()]
+        self.assertIn('attachments.urls', names)
+        self.assertFalse([name for name in names if name.startswith('six')])
+        self.assertNotIn('django.contrib.admin', names)
+
+    def test_import_time_budget(self):
+        budget = int(os.environ.get('ATTACHMENTS_IMPORT_BUDGET_US', 200000))
+        own = sum(
+            cumulative
+            for name, cumulative in self.import_times().items()
+            if name.startswith(' attachments')
+        )
+        self.assertLess(own, budget)
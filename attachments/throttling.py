@@ -0,0 +1,171 @@
+"""
+Throttling of the attachment views, kept in Django's cache framework.
+
+Everything is disabled unless configured:
+
+* ATTACHMENT_THROTTLE_RATE and ATTACHMENT_THROTTLE_BURST: a token bucket per
+  user refilled with RATE requests per second, holding up to BURST.
+* ATTACHMENT_MAX_CONCURRENT_UPLOADS: uploads in flight across all workers.
+* ATTACHMENT_MAX_UPLOAD_SIZE: largest request body accepted by the upload
+  views, checked against Content-Length before the body is read.
+* ATTACHMENT_THROTTLE_CACHE: the cache alias to use, ``default`` by default.
+
+Over the limits the views answer at once with 429 (or 413 for oversized
+uploads) instead of tying up a worker.
+
+The upload limits are best applied by ``UploadLimitMiddleware``, since the
+body has been read by the time a view runs: ``CsrfViewMiddleware`` reads
+``request.POST``. Add ``attachments.middleware.UploadLimitMiddleware``
+before it in MIDDLEWARE. Without it, the ``throttle`` decorator still
+applies them, but only after the body has been received.
+"""
+from functools import wraps
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+
+# How long the in-flight counter survives a worker that died mid-upload.
+IN_FLIGHT_TIMEOUT = 3600
+
+
+def _cache():
+    return caches[getattr(settings, 'ATTACHMENT_THROTTLE_CACHE', 'default')]
+
+
+def _client_key(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return 'user:%s' % user.pk
+    return 'ip:%s' % request.META.get('REMOTE_ADDR', '')
+
+
+def too_many_requests(retry_after):
+    response = HttpResponse('Too many requests', status=429,
+                            content_type='text/plain')
+    response['Retry-After'] = str(int(math.ceil(retry_after)))
+    return response
+
+
+def take_token(key, rate, burst):
+    """
+    Takes a token from the bucket ``key``. Returns 0 on success, or the
+    number of seconds until a token is available.
+
+    The read and write are not atomic, so concurrent requests may briefly
+    overdraw the bucket; that's the trade-off for working on any cache.
+    """
+    cache = _cache()
+    key = 'attachments:bucket:%s' % key
+    now = time.time()
+    tokens, updated = cache.get(key, (burst, now))
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens < 1:
+        return (1 - tokens) / rate
+    cache.set(key, (tokens - 1, now), int(math.ceil(burst / rate)) + 1)
+    return 0
+
+
+def acquire_upload_slot(limit):
+    """
+    Counts one more upload in flight, unless ``limit`` uploads already are.
+    """
+    cache = _cache()
+    key = 'attachments:uploads-in-flight'
+    cache.add(key, 0, IN_FLIGHT_TIMEOUT)
+    try:
+        in_flight = cache.incr(key)
+    except ValueError:
+        # Expired between add() and incr().
+        cache.add(key, 1, IN_FLIGHT_TIMEOUT)
+        in_flight = 1
+    if in_flight > limit:
+        release_upload_slot()
+        return False
+    return True
+
+
+def release_upload_slot():
+    cache = _cache()
+    key = 'attachments:uploads-in-flight'
+    try:
+        in_flight = cache.decr(key)
+    except ValueError:
+        return
+    if in_flight < 0:
+        # The counter expired while this upload was in flight and was
+        # started again without it; don't let it go below zero.
+        try:
+            cache.incr(key, -in_flight)
+        except ValueError:
+            pass
+
+
+def check_upload(request):
+    """
+    Applies the upload size and concurrency limits to ``request``. Returns
+    the response refusing it, or None after taking an upload slot if
+    ATTACHMENT_MAX_CONCURRENT_UPLOADS is set; release it with
+    ``release_upload``.
+    """
+    request._attachment_upload_checked = True
+    max_size = getattr(settings, 'ATTACHMENT_MAX_UPLOAD_SIZE', None)
+    if max_size is not None:
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length > max_size:
+            return HttpResponse(
+                'Upload too large', status=413, content_type='text/plain')
+
+    limit = getattr(settings, 'ATTACHMENT_MAX_CONCURRENT_UPLOADS', None)
+    if limit is not None:
+        if not acquire_upload_slot(limit):
+            return too_many_requests(1)
+        request._attachment_upload_slot = True
+    return None
+
+
+def release_upload(request):
+    """
+    Releases the upload slot ``check_upload`` took for ``request``, if any.
+    """
+    if getattr(request, '_attachment_upload_slot', False):
+        request._attachment_upload_slot = False
+        release_upload_slot()
+
+
+def throttle(upload=False):
+    """
+    View decorator applying the per-user token bucket. Views with
+    ``upload`` set are marked for the upload limits of
+    ``UploadLimitMiddleware``, and apply them to POSTs themselves if the
+    middleware didn't.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            rate = getattr(settings, 'ATTACHMENT_THROTTLE_RATE', None)
+            if rate:
+                burst = getattr(settings, 'ATTACHMENT_THROTTLE_BURST', 1)
+                wait = take_token(_client_key(request), rate, burst)
+                if wait:
+                    return too_many_requests(wait)
+            if not upload or request.method != 'POST' or \
+                    getattr(request, '_attachment_upload_checked', False):
+                return view(request, *args, **kwargs)
+            response = check_upload(request)
+            if response is not None:
+                return response
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                release_upload(request)
+        # Copied onto outer decorators by functools.wraps.
+        wrapper.attachment_upload = upload
+        return wrapper
+    return decorator
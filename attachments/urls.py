@@ -1,16 +1,18 @@
 from django.urls import re_path
-from django.contrib import admin
 
 import attachments.views
 
-admin.autodiscover()
-
 urlpatterns = (
     re_path(
         r'^(?P<content_type>\d+)/(?P<object_id>\d+)/$',
         attachments.views.list_attachments,
         name='attachment_list',
     ),
+    re_path(
+        r'^(?P<content_type>\d+)/(?P<object_id>\d+)/zip/$',
+        attachments.views.download_attachments,
+        name='attachment_download_all',
+    ),
     re_path(
         r'^(?P<content_type>\d+)/(?P<object_id>\d+)/new/$',
         attachments.views.new_attachment,
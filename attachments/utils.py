@@ -1,31 +1,147 @@
+from django.conf import settings
 from django.template.defaultfilters import slugify
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import Q
 
 import re
+import threading
+
+
+# Characters kept free at the end of a truncated slug for the numeric suffix
+# (enough for ``-99999999``), so every candidate shares one query prefix.
+SLUG_SUFFIX_RESERVE = 9
 
 
 def set_slug_field(
-        instance, value, slug_field_name='slug', slug_separator='-'):
+        instance, value, slug_field_name='slug', slug_separator='-',
+        queryset=None):
     """
     Calculates a unique slug of ``value`` for an instance.
 
     ``slug_field_name`` should be a string matching the name of the field to
     store the slug in (and the field to check against for uniqueness).
 
+    ``queryset`` usually doesn't need to be explicitly provided - it'll
+    default to using the ``.all()`` queryset from the model's default
+    manager.
+
     from http://www.djangosnippets.org/snippets/690/
     """
+    set_slug_fields(
+        [instance],
+        [value],
+        queryset=queryset,
+        slug_field_name=slug_field_name,
+        slug_separator=slug_separator,
+    )
+
+
+def set_slug_fields(
+        instances, values, queryset=None, slug_field_name='slug',
+        slug_separator='-', keep_current=False):
+    """
+    Calculates unique slugs for a batch of instances sharing one
+    ``queryset`` scope.
 
-    slug_field = instance._meta.get_field(slug_field_name)
+    The slugs already in use are fetched with a single prefix query on the
+    slug column; suffixes (``-2``, ``-3``, ...) are then searched in memory,
+    so the cost doesn't grow with the number of collisions. An instance
+    keeps its current slug as long as it is still valid for ``value``, or
+    with ``keep_current`` as long as it is free at all.
+    """
+    instances = list(instances)
+    if not instances:
+        return
 
-    slug = getattr(instance, slug_field.attname)
+    model = instances[0].__class__
+    slug_field = model._meta.get_field(slug_field_name)
     slug_len = slug_field.max_length
 
-    # Sort out the initial slug. Chop its length down if we need to.
-    slug = slugify(value)
-    if slug_len:
-        slug = slug[:slug_len]
-    slug = _slug_strip(slug, slug_separator)
-    setattr(instance, slug_field.attname, slug)
+    if queryset is None:
+        queryset = model._default_manager.all()
+    pks = [instance.pk for instance in instances if instance.pk is not None]
+    if pks:
+        queryset = queryset.exclude(pk__in=pks)
+
+    # Sort out the initial slugs. Chop their length down if we need to.
+    slugs = []
+    for value in values:
+        slug = slugify(value)
+        if slug_len:
+            slug = slug[:slug_len]
+        slugs.append(_slug_strip(slug, slug_separator))
+
+    prefixes = set()
+    for slug in slugs:
+        if slug_len and len(slug) > slug_len - SLUG_SUFFIX_RESERVE:
+            slug = _slug_strip(
+                slug[:slug_len - SLUG_SUFFIX_RESERVE], slug_separator)
+        prefixes.add(slug)
+    if keep_current:
+        for instance in instances:
+            current = getattr(instance, slug_field.attname)
+            if current:
+                prefixes.add(current)
+
+    lookup = '%s__startswith' % slug_field.attname
+    query = Q()
+    for prefix in prefixes:
+        query |= Q(**{lookup: prefix})
+    taken = set(
+        queryset.filter(query).values_list(slug_field.attname, flat=True)
+    )
+
+    for instance, slug in zip(instances, slugs):
+        current = getattr(instance, slug_field.attname)
+        valid = bool(current) if keep_current else _is_slug_candidate(
+            current, slug, slug_len, slug_separator)
+        if not valid or current in taken:
+            current = _unique_slug(slug, taken, slug_len, slug_separator)
+        taken.add(current)
+        setattr(instance, slug_field.attname, current)
+
+
+def _slug_candidate(slug, n, slug_len, separator):
+    """
+    Returns the ``n``-th candidate for ``slug``: the slug itself for
+    ``n == 1``, then ``slug-2``, ``slug-3`` and so on, truncated so the
+    suffix fits in ``slug_len``.
+    """
+    if n == 1:
+        return slug
+    end = '%s%s' % (separator, n)
+    if slug_len and len(slug) + len(end) > slug_len:
+        slug = _slug_strip(slug[:slug_len - len(end)], separator)
+    return '%s%s' % (slug, end)
+
+
+def _is_slug_candidate(value, slug, slug_len, separator):
+    """
+    Whether ``value`` is one of the candidates ``_slug_candidate`` can
+    produce for ``slug``.
+    """
+    if value is None:
+        return False
+    if value == slug:
+        return True
+    match = re.match(r'^.*%s(\d+)$' % re.escape(separator), value)
+    if match is None:
+        return False
+    n = int(match.group(1))
+    return n >= 2 and _slug_candidate(slug, n, slug_len, separator) == value
+
+
+def _unique_slug(slug, taken, slug_len, separator):
+    """
+    Returns the first candidate for ``slug`` which isn't in ``taken``.
+    """
+    n = 1
+    candidate = slug
+    while candidate in taken:
+        n += 1
+        candidate = _slug_candidate(slug, n, slug_len, separator)
+    return candidate
 
 
 def _slug_strip(value, separator=None):
@@ -66,3 +182,34 @@ def get_callable_from_string(path):
         )
 
     return func
+
+
+def run_in_thread(func, *args, **kwargs):
+    """
+    Runs ``func`` in a daemon thread, closing the thread's database
+    connection once it is done.
+    """
+    def target():
+        try:
+            func(*args, **kwargs)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def run_in_background(func, *args, **kwargs):
+    """
+    Hands ``func`` to the runner named by the ATTACHMENT_BACKGROUND_RUNNER
+    setting (in the same string format as TEMPLATE_LOADERS), which is
+    called as ``runner(func, *args, **kwargs)``. Defaults to
+    ``run_in_thread``; point it at a task queue for real deployments.
+    """
+    runner = run_in_thread
+    if getattr(settings, 'ATTACHMENT_BACKGROUND_RUNNER', None):
+        runner = get_callable_from_string(
+            settings.ATTACHMENT_BACKGROUND_RUNNER)
+    return runner(func, *args, **kwargs)
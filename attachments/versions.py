@@ -0,0 +1,57 @@
+"""
+Cache versions of each object's attachments.
+
+Every change to the attachments of an object gives it a new version, so
+anything cached under the version, like the ``attachments`` tag fragment,
+goes stale without having to be deleted. The versions live in the cache
+named by ATTACHMENT_FRAGMENT_CACHE (``default`` by default), so that cache
+has to be shared between processes for versions bumped in one to be seen
+by the others; the per-process ``LocMemCache`` won't do.
+
+Saves, deletes and the manager's ``bulk_create`` and ``bulk_update`` bump
+the versions; ``QuerySet.update()`` does not.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+def _cache():
+    return caches[getattr(settings, 'ATTACHMENT_FRAGMENT_CACHE', 'default')]
+
+
+def _key(content_type_id, object_id):
+    return 'attachments:version:%s:%s' % (content_type_id, object_id)
+
+
+def get_version(content_type_id, object_id):
+    """
+    Returns the current version of the attachments of an object.
+    """
+    cache = _cache()
+    key = _key(content_type_id, object_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_versions(scopes):
+    """
+    Gives new versions to the ``(content_type_id, object_id)`` pairs in
+    ``scopes``, now and again once the current transaction commits, so a
+    fragment rendered from uncommitted data doesn't outlive the commit.
+    """
+    keys = [_key(*scope) for scope in set(scopes)]
+    if not keys:
+        return
+
+    def bump():
+        _cache().set_many(
+            dict((key, uuid.uuid4().hex) for key in keys), None)
+
+    bump()
+    transaction.on_commit(bump)
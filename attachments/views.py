@@ -1,16 +1,28 @@
 import json
+import zipfile
 
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseRedirect, Http404, HttpResponse
+from django.http import (
+    HttpResponseRedirect,
+    Http404,
+    HttpResponse,
+    StreamingHttpResponse,
+)
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
 from django.core import serializers
 
-from attachments.models import Attachment
+from attachments.archive import stream_zip
+from attachments.models import Attachment, QuotaExceeded, SUMMARY_VIEW_FIELDS
+from attachments.quotas import quota_error
+from attachments.throttling import throttle
 from attachments.forms import AttachmentForm, AttachmentEditForm
+from attachments.instrumentation import instrument
 
 
 @login_required
+@throttle(upload=True)
+@instrument('view.new_attachment')
 def new_attachment(
     request,
     content_type,
@@ -25,16 +37,27 @@ def new_attachment(
     except object_type.DoesNotExist:
         raise Http404
     if request.method == "POST":
-        attachment_form = form_cls(request.POST, request.FILES)
+        kwargs = {}
+        if issubclass(form_cls, AttachmentForm):
+            # Only AttachmentForm knows about the quota arguments; custom
+            # forms may not.
+            kwargs = {'content_object': object, 'user': request.user}
+        attachment_form = form_cls(request.POST, request.FILES, **kwargs)
         if attachment_form.is_valid():
             attachment = attachment_form.save(content_object=object,
                                               commit=False)
             attachment.attached_by = request.user
-            attachment.save()
-            if callable(redirect):
-                return HttpResponseRedirect(redirect(object, attachment))
+            try:
+                attachment.save(enforce_quotas=True)
+            except QuotaExceeded as e:
+                # A concurrent upload used up the quota after validation.
+                attachment.file.delete(save=False)
+                attachment_form.add_error('file', quota_error(e))
             else:
-                return HttpResponseRedirect(redirect)
+                if callable(redirect):
+                    return HttpResponseRedirect(redirect(object, attachment))
+                else:
+                    return HttpResponseRedirect(redirect)
     else:
         attachment_form = form_cls()
 
@@ -45,6 +68,8 @@ def new_attachment(
 
 
 @login_required
+@throttle(upload=True)
+@instrument('view.edit_attachment')
 def edit_attachment(
     request,
     attachment_id,
@@ -55,16 +80,27 @@ def edit_attachment(
     attachment = get_object_or_404(Attachment, pk=attachment_id)
 
     if request.method == "POST":
+        kwargs = {}
+        if issubclass(form_cls, AttachmentEditForm):
+            kwargs = {'user': request.user}
         attachment_form = form_cls(request.POST, request.FILES,
-                                   instance=attachment)
+                                   instance=attachment, **kwargs)
         if attachment_form.is_valid():
             attachment = attachment_form.save(commit=False)
             attachment.attached_by = request.user
-            attachment.save()
-            if callable(redirect):
-                return HttpResponseRedirect(redirect(object, attachment))
+            uploaded = not attachment.file._committed
+            try:
+                attachment.save(enforce_quotas=True)
+            except QuotaExceeded as e:
+                if uploaded:
+                    # Only the new file; the old one is still in use.
+                    attachment.file.delete(save=False)
+                attachment_form.add_error('file', quota_error(e))
             else:
-                return HttpResponseRedirect(redirect)
+                if callable(redirect):
+                    return HttpResponseRedirect(redirect(object, attachment))
+                else:
+                    return HttpResponseRedirect(redirect)
     else:
         attachment_form = form_cls(instance=attachment)
 
@@ -74,6 +110,8 @@ def edit_attachment(
 
 
 @login_required
+@throttle()
+@instrument('view.delete_attachment')
 def delete_attachment(request, attachment_id, redirect=None):
     attachment = get_object_or_404(Attachment, pk=attachment_id)
     if request.method == "POST":
@@ -91,7 +129,15 @@ def delete_attachment(request, attachment_id, redirect=None):
 
 
 @login_required
-def list_attachments(request, content_type, object_id, order_by=None):
+@throttle()
+@instrument('view.list_attachments')
+def list_attachments(
+    request,
+    content_type,
+    object_id,
+    order_by=None,
+    summary_view=False,
+):
     object_type = get_object_or_404(ContentType, id=int(content_type))
     try:
         object = object_type.get_object_for_this_type(pk=int(object_id))
@@ -100,8 +146,47 @@ def list_attachments(request, content_type, object_id, order_by=None):
 
     attachments = Attachment.objects.attachments_for_object(object)
 
+    fields = None
+    if summary_view:
+        attachments = attachments.summary_view()
+        fields = SUMMARY_VIEW_FIELDS
+
     if order_by:
         attachments = attachments.order_by(*order_by)
 
-    data = serializers.serialize('json', attachments)
+    data = serializers.serialize('json', attachments, fields=fields)
     return HttpResponse(data, content_type='application/json')
+
+
+@login_required
+@throttle()
+@instrument('view.download_attachments')
+def download_attachments(
+    request,
+    content_type,
+    object_id,
+    compression=zipfile.ZIP_STORED,
+):
+    """
+    Streams a ZIP archive of all attachments of an object, reading each
+    file in chunks so the response starts at once and memory stays flat.
+    """
+    object_type = get_object_or_404(ContentType, id=int(content_type))
+    try:
+        object = object_type.get_object_for_this_type(pk=int(object_id))
+    except object_type.DoesNotExist:
+        raise Http404
+
+    attachments = Attachment.objects.attachments_for_object(object)
+    files = (
+        (attachment.file_name(), attachment.file)
+        for attachment in attachments.iterator()
+        if attachment.file
+    )
+    response = StreamingHttpResponse(
+        stream_zip(files, compression),
+        content_type='application/zip',
+    )
+    response['Content-Disposition'] = 'attachment; filename="%s-%s.zip"' % (
+        object_type.model, object.pk)
+    return response
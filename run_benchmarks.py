@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the attachments hot paths.
+
+Builds synthetic SQLite fixtures of the requested sizes, times each
+benchmark, records its query count and peak memory and optionally writes
+the results as JSON so they can be compared across commits::
+
+    python run_benchmarks.py --sizes 1000 100000 --output before.json
+    python run_benchmarks.py --sizes 1000 100000 --output after.json \
+        --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from django.conf import settings
+
+WORK_DIR = tempfile.mkdtemp(prefix='attachments-bench-')
+
+if not settings.configured:
+    settings.configure(
+        SECRET_KEY='this-is-a-key-for-benchmark-purposes-only',
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(WORK_DIR, 'bench.sqlite3'),
+            }
+        },
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'attachments',
+        ),
+        ROOT_URLCONF='attachments.urls',
+        MEDIA_ROOT=os.path.join(WORK_DIR, 'media'),
+        DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+        TEMPLATES=[
+            {
+                'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                'DIRS': [],
+                'APP_DIRS': True,
+            },
+        ],
+    )
+
+import django  # noqa E402
+
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa E402
+from django.contrib.contenttypes.models import ContentType  # noqa E402
+from django.core.files.uploadedfile import SimpleUploadedFile  # noqa E402
+from django.core.management import call_command  # noqa E402
+from django.db import connection  # noqa E402
+from django.template import Context, Template  # noqa E402
+from django.test.client import RequestFactory  # noqa E402
+from django.test.utils import CaptureQueriesContext  # noqa E402
+from django.urls import reverse  # noqa E402
+
+from attachments.forms import AttachmentForm  # noqa E402
+from attachments.models import Attachment  # noqa E402
+from attachments.views import list_attachments  # noqa E402
+
+
+User = get_user_model()
+
+# Attachments per content object in the synthetic fixtures.
+PER_OBJECT = 100
+SUMMARY = 'Lorem ipsum dolor sit amet. ' * 8
+LONG_SUMMARY = SUMMARY * 64
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """
+    Registers ``func(fixture)`` as the benchmark ``name``.
+    """
+    def decorator(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return decorator
+
+
+class Fixture(object):
+    """
+    ``size`` attachments spread over ``size // PER_OBJECT`` users, the
+    content objects of the fixture.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        objects = max(1, size // PER_OBJECT)
+
+        call_command('flush', interactive=False, verbosity=0)
+        ContentType.objects.clear_cache()
+        User.objects.bulk_create(
+            User(username='user%d' % i) for i in range(objects + 2))
+        users = list(User.objects.order_by('pk'))
+        self.owner = users[0]
+        self.long_target = users[1]
+        self.objects = users[2:]
+        self.target = self.objects[0]
+        self.empty = self.owner
+        self.content_type = ContentType.objects.get_for_model(User)
+
+        batch = []
+        for i in range(size):
+            obj = self.objects[i // PER_OBJECT % objects]
+            batch.append(Attachment(
+                file='attachments/bench/%d.txt' % i,
+                content_type=self.content_type,
+                object_id=obj.pk,
+                title='Attachment %d' % i,
+                slug='attachment-%d' % i,
+                summary=SUMMARY,
+                attached_by=self.owner,
+            ))
+            if len(batch) == 10000:
+                self._insert(batch)
+                batch = []
+        self._insert(batch)
+
+        # An object whose attachments have long summaries, for the
+        # summary view benchmarks.
+        self._insert([
+            Attachment(
+                file='attachments/bench/long-%d.txt' % i,
+                content_type=self.content_type,
+                object_id=self.long_target.pk,
+                title='Long %d' % i,
+                slug='long-%d' % i,
+                summary=LONG_SUMMARY,
+                attached_by=self.owner,
+            )
+            for i in range(PER_OBJECT * 5)
+        ])
+
+    def _insert(self, batch):
+        # Slugs are already unique, so skip the manager's slug assignment.
+        Attachment.objects.get_queryset().bulk_create(batch)
+
+
+@benchmark('attachments_for_object')
+def bench_attachments_for_object(fixture):
+    list(Attachment.objects.attachments_for_object(fixture.target))
+
+
+@benchmark('usage_for_queryset')
+def bench_usage_for_queryset(fixture):
+    pks = [obj.pk for obj in fixture.objects[:10]]
+    Attachment.objects.usage_for_queryset(
+        User.objects.filter(pk__in=pks), counts=True)
+
+
+@benchmark('attachments_for_object_long_summaries')
+def bench_attachments_for_object_long(fixture):
+    list(Attachment.objects.attachments_for_object(fixture.long_target))
+
+
+@benchmark('attachments_for_object_summary_view')
+def bench_attachments_for_object_summary_view(fixture):
+    list(Attachment.objects.attachments_for_object(
+        fixture.long_target).summary_view())
+
+
+@benchmark('copy_attachments')
+def bench_copy_attachments(fixture):
+    Attachment.objects.copy_attachments(fixture.target, fixture.empty)
+
+
+@benchmark('list_attachments')
+def bench_list_attachments(fixture):
+    request = RequestFactory().get('/')
+    request.user = fixture.owner
+    list_attachments(request, fixture.content_type.pk, fixture.target.pk)
+
+
+GET_ATTACHMENTS = Template(
+    '{% load attachment_tags %}'
+    '{% get_attachments for object as attachments %}'
+    '{% for attachment in attachments %}'
+    '{{ attachment.title }}{{ attachment.attached_timestamp }}'
+    '{% endfor %}'
+)
+
+
+@benchmark('get_attachments_tag')
+def bench_get_attachments_tag(fixture):
+    GET_ATTACHMENTS.render(Context({'object': fixture.target}))
+
+
+ATTACHMENTS_FRAGMENT = Template(
+    '{% load attachment_inclusion_tag %}{% attachments object %}'
+)
+
+
+@benchmark('attachments_tag')
+def bench_attachments_tag(fixture):
+    ATTACHMENTS_FRAGMENT.render(Context({
+        'object': fixture.target,
+        'user': fixture.owner,
+    }))
+
+
+NEW_ATTACHMENT_URL = Template(
+    '{% load attachment_tags %}'
+    '{% for object in objects %}{% new_attachment_url object %}{% endfor %}'
+)
+
+
+@benchmark('new_attachment_url_tag')
+def bench_new_attachment_url_tag(fixture):
+    NEW_ATTACHMENT_URL.render(Context({'objects': fixture.objects[:100]}))
+
+
+NEW_ATTACHMENT_URLS = Template(
+    '{% load attachment_tags %}'
+    '{% new_attachment_urls objects as pairs %}'
+    '{% for object, url in pairs %}{{ url }}{% endfor %}'
+)
+
+
+@benchmark('new_attachment_urls_tag')
+def bench_new_attachment_urls_tag(fixture):
+    NEW_ATTACHMENT_URLS.render(Context({'objects': fixture.objects[:100]}))
+
+
+@benchmark('new_attachment_url_reverse')
+def bench_new_attachment_url_reverse(fixture):
+    # The former new_attachment_url: one reverse() per object.
+    for obj in fixture.objects[:100]:
+        reverse('attachment_new', kwargs={
+            'content_type': ContentType.objects.get_for_model(obj).id,
+            'object_id': obj.pk,
+        })
+
+
+@benchmark('upload')
+def bench_upload(fixture):
+    form = AttachmentForm(
+        {
+            'title': 'Upload',
+            'summary': SUMMARY,
+            'attached_timestamp': '2020-01-01 00:00:00',
+        },
+        {'file': SimpleUploadedFile('upload.txt', b'x' * 65536)},
+    )
+    assert form.is_valid(), form.errors
+    attachment = form.save(content_object=fixture.target, commit=False)
+    attachment.attached_by = fixture.owner
+    attachment.save()
+
+
+def measure(func, fixture, repeat):
+    """
+    Returns timings, query count and peak traced memory for ``func``.
+    """
+    func(fixture)  # warm up caches and lazy imports
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(fixture)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    with CaptureQueriesContext(connection) as queries:
+        func(fixture)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'queries': len(queries),
+        'peak_memory': peak,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Prints the median time ratio of every benchmark against ``baseline``.
+    """
+    old = {
+        (size, name): values
+        for size, benchmarks in baseline['results'].items()
+        for name, values in benchmarks.items()
+    }
+    for size, benchmarks in results['results'].items():
+        for name, values in benchmarks.items():
+            previous = old.get((size, name))
+            if previous:
+                print('%8s %-28s %6.2fx time %+d queries' % (
+                    size,
+                    name,
+                    values['median'] / previous['median'],
+                    values['queries'] - previous['queries'],
+                ))
+
+
+def runbenchmarks():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1000],
+        help='fixture sizes in attachments, e.g. 1000 100000 1000000')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--only', nargs='+', help='names of the benchmarks to run')
+    parser.add_argument('--output', help='write the results as JSON here')
+    parser.add_argument('--compare', help='JSON results to compare against')
+    args = parser.parse_args()
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'repeat': args.repeat,
+        'results': {},
+    }
+    try:
+        for size in args.sizes:
+            fixture = Fixture(size)
+            sized = results['results'][str(size)] = {}
+            for name, func in BENCHMARKS:
+                if args.only and name not in args.only:
+                    continue
+                sized[name] = values = measure(func, fixture, args.repeat)
+                print('%8d %-28s %9.2f ms %5d queries %9d KiB' % (
+                    size,
+                    name,
+                    values['median'] * 1000,
+                    values['queries'],
+                    values['peak_memory'] // 1024,
+                ))
+    finally:
+        connection.close()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    sys.exit(runbenchmarks())
@@ -23,6 +23,8 @@ if not settings.configured:
         MIDDLEWARE=(
             'django.contrib.sessions.middleware.SessionMiddleware',
             'django.contrib.auth.middleware.AuthenticationMiddleware',
+            'attachments.middleware.UploadLimitMiddleware',
+            'django.middleware.csrf.CsrfViewMiddleware',
             'attachments.middleware.AcceptMiddleware',
         ),
         ROOT_URLCONF='attachments.urls',
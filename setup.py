@@ -14,6 +14,8 @@ setup(
     url='http://github.com/akaihola/django-attachments',
     packages=[
         'attachments',
+        'attachments.management',
+        'attachments.management.commands',
         'attachments.templatetags',
     ],
     package_data={'attachments': data},